@@ -0,0 +1,105 @@
+'''
+The contract every tree hole backend implements, as a unittest suite.
+
+A backend class has slug, label, form_class (whose to_json() gives the
+params) and max_length, and make_client(pk, params) returns a client
+whose make_message(text) returns a message. publish(POST, FILES,
+form_prefix='backend', queue=False) returns a dict with one of:
+
+* 'data': a string stored in Message.backend_data,
+* 'forms': a list of bound forms the user must fill in (e.g. a captcha),
+* 'error': an ErrorList shown on the text field,
+* 'queued': only if queue is set; the message should go to moderation.
+
+Run it against any backend with multitreehole_check_backend, or build
+a test case with make_test_case() (or a suite with make_suite()) in a
+project's own tests.
+'''
+
+from django import forms
+from django.forms.util import ErrorList
+
+import json
+import unittest
+
+MEMORY_BACKEND_PATH = 'multitreehole.backends.memory.MemoryBackend'
+
+# Params of the stand-in backend forcing every kind of publish outcome.
+MEMORY_CONFIGS = [
+    {'seed': 0},
+    {'seed': 0, 'captcha-rate': 1},
+    {'seed': 0, 'error-rate': 1},
+    {'seed': 0, 'reject-rate': 1},
+    {'seed': 0, 'max-length': 1},
+    {'seed': 0, 'captcha-rate': 0.25, 'error-rate': 0.25, 'reject-rate': 0.25},
+]
+
+class BackendContractTestCase(unittest.TestCase):
+    backend_path = None
+    backend_params = '{}'
+    backend_pk = 0
+    text = u'Contract test message \u6811\u6d1e'
+
+    def setUp(self):
+        from multitreehole.utils import load_backend
+        self.backend = load_backend(self.backend_path)
+        self.client = self.backend.make_client(self.backend_pk, self.backend_params)
+
+    def check_status(self, status, queue=False):
+        self.assertTrue(isinstance(status, dict))
+        keys = set(status) & set(['data', 'forms', 'error', 'queued'])
+        self.assertTrue(keys, 'publish() returned none of the known keys: %r' % status)
+        if 'queued' in status:
+            self.assertTrue(queue, "'queued' returned although queueing was not allowed")
+        if 'data' in status:
+            self.assertTrue(isinstance(status['data'], basestring))
+            self.assertFalse(keys - set(['data']), "'data' returned together with %r" % keys)
+        if 'forms' in status:
+            self.assertTrue(status['forms'])
+            for form in status['forms']:
+                self.assertTrue(isinstance(form, forms.BaseForm))
+                self.assertTrue(form.is_bound)
+        if 'error' in status:
+            self.assertTrue(isinstance(status['error'], ErrorList))
+
+    def test_attributes(self):
+        self.assertTrue(self.backend.slug)
+        self.assertTrue(unicode(self.backend.label))
+        self.assertTrue(issubclass(self.backend.form_class, forms.BaseForm))
+        self.assertTrue(hasattr(self.backend.form_class, 'to_json'))
+        max_length = getattr(self.backend, 'max_length', None)
+        self.assertTrue(max_length is None or max_length > 0)
+
+    def test_params_are_json(self):
+        json.loads(self.backend_params)
+
+    def test_publish(self):
+        status = self.client.make_message(self.text).publish({}, {})
+        self.check_status(status)
+
+    def test_publish_with_prefix(self):
+        status = self.client.make_message(self.text).publish({}, {}, form_prefix='message_1')
+        self.check_status(status)
+        for form in status.get('forms', []):
+            self.assertEqual(form.prefix, 'message_1')
+
+    def test_publish_queue(self):
+        status = self.client.make_message(self.text).publish({}, {}, queue=True)
+        self.check_status(status, queue=True)
+
+    def test_client_reuse(self):
+        # Clients are cached per Backend.pk and shared between requests.
+        for i in range(3):
+            self.check_status(self.client.make_message(self.text).publish({}, {}))
+
+def make_test_case(backend_path, backend_params='{}', backend_pk=0,
+        name='BackendContractTestCase'):
+    return type(name, (BackendContractTestCase,), {
+        'backend_path': backend_path,
+        'backend_params': backend_params,
+        'backend_pk': backend_pk,
+    })
+
+def make_suite(backend_path, backend_params='{}', backend_pk=0):
+    test_case = make_test_case(backend_path, backend_params, backend_pk)
+    return unittest.TestLoader().loadTestsFromTestCase(test_case)
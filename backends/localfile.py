@@ -15,6 +15,7 @@ class LocalFileBackend(object):
     slug = 'local-file'
     label = _('Local file')
     form_class = LocalFileBackendForm
+    max_length = None
 
     def make_client(self, pk, params):
         params = json.loads(params)
@@ -34,7 +35,7 @@ class LocalFileMessage(object):
         self.client = client
         self.text = text
 
-    def publish(self, POST, FILES, form_prefix='backend'):
+    def publish(self, POST, FILES, form_prefix='backend', queue=False):
         file_obj = file.__new__(file, self.client.file_name, 'a')
         try:
             from google.appengine.tools.dev_appserver import FakeFile
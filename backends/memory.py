@@ -0,0 +1,131 @@
+from django import forms
+from django.forms.util import ErrorList
+from django.utils.translation import ugettext_lazy as _
+
+import json
+import random
+import threading
+import time
+
+# Backend.pk -> list of published texts, shared by all clients in the process.
+published = {}
+published_lock = threading.Lock()
+
+CAPTCHA_ANSWER = 'memory'
+
+class MemoryBackendForm(forms.Form):
+    latency = forms.FloatField(initial=0, min_value=0,
+        help_text=_('Mean seconds per publish.'))
+    latency_jitter = forms.FloatField(initial=0, min_value=0,
+        help_text=_('Standard deviation of the latency.'))
+    captcha_rate = forms.FloatField(initial=0, min_value=0, max_value=1)
+    error_rate = forms.FloatField(initial=0, min_value=0, max_value=1)
+    reject_rate = forms.FloatField(initial=0, min_value=0, max_value=1)
+    max_length = forms.IntegerField(required=False, min_value=1)
+    seed = forms.IntegerField(required=False)
+
+    def to_json(self):
+        return json.dumps({
+            'latency': self.cleaned_data['latency'],
+            'latency-jitter': self.cleaned_data['latency_jitter'],
+            'captcha-rate': self.cleaned_data['captcha_rate'],
+            'error-rate': self.cleaned_data['error_rate'],
+            'reject-rate': self.cleaned_data['reject_rate'],
+            'max-length': self.cleaned_data['max_length'],
+            'seed': self.cleaned_data['seed'],
+        })
+
+class MemoryBackend(object):
+    '''
+    A stand-in backend with no network or disk effects, for load tests and
+    for exercising the publishing machinery offline.
+    '''
+    slug = 'memory'
+    label = _('In-memory stand-in')
+    form_class = MemoryBackendForm
+    max_length = None
+
+    def make_client(self, pk, params):
+        params = json.loads(params)
+        client = MemoryClient(pk,
+            latency=params.get('latency', 0),
+            latency_jitter=params.get('latency-jitter', 0),
+            captcha_rate=params.get('captcha-rate', 0),
+            error_rate=params.get('error-rate', 0),
+            reject_rate=params.get('reject-rate', 0),
+            max_length=params.get('max-length'),
+            seed=params.get('seed'),
+        )
+        return client
+
+class MemoryClient(object):
+    def __init__(self, pk, latency=0, latency_jitter=0, captcha_rate=0,
+            error_rate=0, reject_rate=0, max_length=None, seed=None):
+        self.pk = pk
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.captcha_rate = captcha_rate
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.max_length = max_length
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sleep = time.sleep
+
+    def make_message(self, text):
+        return MemoryMessage(self, text)
+
+    def roll(self):
+        '''
+        Returns the simulated latency and outcome of one publish.
+        '''
+        with self.lock:
+            latency = max(0, self.random.gauss(self.latency, self.latency_jitter)) \
+                    if self.latency_jitter else self.latency
+            value = self.random.random()
+        for outcome, rate in (
+            ('captcha', self.captcha_rate),
+            ('error', self.error_rate),
+            ('reject', self.reject_rate),
+        ):
+            if value < rate:
+                return latency, outcome
+            value -= rate
+        return latency, 'data'
+
+    def get_published(self):
+        with published_lock:
+            return list(published.get(self.pk, []))
+
+class MemoryMessage(object):
+    def __init__(self, client, text):
+        self.client = client
+        self.text = text
+
+    def publish(self, POST, FILES, form_prefix='backend', queue=False):
+        latency, outcome = self.client.roll()
+        if latency:
+            self.client.sleep(latency)
+        if outcome == 'captcha':
+            if queue:
+                return {'queued': True}
+            form = MemoryCaptchaForm(POST, FILES, prefix=form_prefix)
+            if not form.is_valid():
+                return {'forms': [form]}
+            if form.cleaned_data['captcha'] != CAPTCHA_ANSWER:
+                form._errors['captcha'] = ErrorList([_('Incorrect captcha.')])
+                return {'forms': [form]}
+        elif outcome == 'error':
+            return {'error': ErrorList([_('Simulated publishing error.')])}
+        elif outcome == 'reject':
+            return {'error': ErrorList([_('Simulated rejection. Message rejected there?')])}
+        if self.client.max_length and len(self.text) > self.client.max_length:
+            return {'error': ErrorList([_('Message is too long.')])}
+        with published_lock:
+            messages = published.setdefault(self.client.pk, [])
+            messages.append(self.text)
+            number = len(messages)
+        return {'data': json.dumps({'number': number})}
+
+class MemoryCaptchaForm(forms.Form):
+    captcha = forms.CharField(help_text=_('Type "%s".') % CAPTCHA_ANSWER)
@@ -1,6 +1,7 @@
 from django import forms
 from django.conf import settings
 from django.core.cache import cache
+from django.core.mail import send_mail
 from django.forms.util import ErrorList
 from django.utils.encoding import smart_bytes
 from django.utils.html import format_html
@@ -8,7 +9,6 @@ from django.utils.translation import ugettext_lazy as _
 
 import json
 import logging
-import mechanize
 import re
 import traceback
 
@@ -28,6 +28,8 @@ class RenrenBackend(object):
     slug = 'renren'
     label = _('Renren')
     form_class = RenrenBackendForm
+    # Longest status Renren accepts.
+    max_length = 140
 
     def make_client(self, pk, params):
         params = json.loads(params)
@@ -36,39 +38,60 @@ class RenrenBackend(object):
 
 class RenrenClient(object):
     URL_CACHE_KEY = 'multitreehole_backend_renren_url'
+    LOGIN_TIME_CACHE_KEY = 'multitreehole_backend_renren_login_time'
+    LOGIN_REQUIRED_CACHE_KEY = 'multitreehole_backend_renren_login_required'
+    ALERT_CACHE_KEY = 'multitreehole_backend_renren_alert'
 
     def __init__(self, pk, username, password, base_url):
         self.pk = pk
         self.username = username
         self.password = password
         self.base_url = base_url
-        self.url = None
 
-    def get_cache_key(self):
-        return ':'.join([self.URL_CACHE_KEY, str(self.pk)])
+    def get_cache_key(self, prefix=URL_CACHE_KEY):
+        return ':'.join([prefix, str(self.pk)])
 
     def load_cache(self):
-        self.url = cache.get(self.get_cache_key())
-        if self.url:
-            logging.info('Got cached Renren URL: ' + self.url)
+        url = cache.get(self.get_cache_key())
+        if url:
+            logging.info('Got cached Renren URL: ' + url)
         else:
             logging.info('No cached Renren URL.')
+        return url
 
-    def save_cache(self):
-        cache.set(self.get_cache_key(), self.url,
-            getattr(settings, 'MULTITREEHOLE_BACKEND_RENREN_LOGIN_CACHE_TIMEOUT'),
-        )
-        logging.info('Renren URL cached: ' + self.url)
+    def save_cache(self, url, login=True):
+        timeout = getattr(settings, 'MULTITREEHOLE_BACKEND_RENREN_LOGIN_CACHE_TIMEOUT')
+        cache.set(self.get_cache_key(), url, timeout)
+        if login:
+            import time
+            cache.set(self.get_cache_key(self.LOGIN_TIME_CACHE_KEY), time.time(), None)
+            cache.delete(self.get_cache_key(self.LOGIN_REQUIRED_CACHE_KEY))
+            cache.delete(self.get_cache_key(self.ALERT_CACHE_KEY))
+        logging.info('Renren URL cached: ' + url)
+
+    def get_login_time(self):
+        return cache.get(self.get_cache_key(self.LOGIN_TIME_CACHE_KEY))
+
+    def is_login_required(self):
+        return bool(cache.get(self.get_cache_key(self.LOGIN_REQUIRED_CACHE_KEY)))
+
+    def mark_login_required(self):
+        cache.set(self.get_cache_key(self.LOGIN_REQUIRED_CACHE_KEY), True, None)
+        cache.delete(self.get_cache_key())
+        logging.warning('Renren session marked as requiring login.')
 
     def make_browser(self):
+        # Imported here so that loading the backend stays cheap on cold starts.
+        import mechanize
         browser = mechanize.Browser()
         browser.set_handle_robots(False)
         return browser
 
     def get_url(self, force=False, captcha_key=None, captcha=None):
-        if not self.url:
-            self.load_cache()
-        if (not self.url or force) and captcha_key and captcha:
+        # Clients are shared between threads and processes log in or out
+        # through the cache, so the URL is read every time and kept local.
+        url = self.load_cache()
+        if (not url or force) and captcha_key and captcha:
             try:
                 browser = self.make_browser()
                 browser.open(self.base_url)
@@ -85,9 +108,76 @@ class RenrenClient(object):
                 return None
             else:
                 logging.info('Renren URL fetched: ' + url)
-                self.url = url
-                self.save_cache()
-        return self.url
+                self.save_cache(url)
+        return url
+
+    def check_session(self, url):
+        '''
+        Opens the logged-in page and makes sure the status form is still there.
+        Raises an exception if the session is no longer valid.
+        '''
+        browser = self.make_browser()
+        browser.open(url)
+        browser.select_form(nr=0)
+        browser.form.find_control('status')
+        return browser
+
+    def keepalive(self):
+        '''
+        Validates the cached session and extends it in the cache.
+
+        Meant to run periodically, well within the login cache timeout.
+        Returns 'ok', 'expiring' (valid but old enough that owners should
+        log in again soon) or 'login-required'.
+        '''
+        url = self.load_cache()
+        if not url:
+            self.mark_login_required()
+            return 'login-required'
+        try:
+            self.check_session(url)
+        except Exception:
+            logging.warning('Renren session validation error: ' + traceback.format_exc())
+            self.mark_login_required()
+            return 'login-required'
+        self.save_cache(url, login=False)
+        max_age = getattr(settings, 'MULTITREEHOLE_BACKEND_RENREN_SESSION_WARN_AGE', None)
+        login_time = self.get_login_time()
+        if max_age is not None and login_time is not None:
+            import time
+            if time.time() - login_time > max_age:
+                return 'expiring'
+        return 'ok'
+
+    def alert_owners(self, status):
+        '''
+        Mails owners of every service using this backend, at most once per
+        login (or per MULTITREEHOLE_BACKEND_RENREN_ALERT_INTERVAL seconds).
+        '''
+        from django.contrib.auth.models import User
+        from multitreehole.models import Service
+        if not cache.add(self.get_cache_key(self.ALERT_CACHE_KEY), status,
+                getattr(settings, 'MULTITREEHOLE_BACKEND_RENREN_ALERT_INTERVAL', 6 * 3600)):
+            return
+        if status == 'login-required':
+            subject = _('Renren login required for your tree hole')
+            body = _('The Renren session has expired. New messages are queued '
+                'for moderation; approving one of them will ask for a captcha '
+                'and log in again.')
+        else:
+            subject = _('Renren login will expire soon for your tree hole')
+            body = _('The Renren session is getting old. Approve a queued '
+                'message or reconfigure the backend to log in again before '
+                'it expires.')
+        for service in Service.objects.filter(backend__pk=self.pk):
+            emails = [user.email for user in User.objects.filter(pk__in=list(service.owners)) if user.email]
+            if not emails:
+                continue
+            try:
+                send_mail(u'[%s] %s' % (service.label, subject), unicode(body),
+                    settings.DEFAULT_FROM_EMAIL, emails)
+            except Exception:
+                logging.warning('Renren alert mailing error: ' + traceback.format_exc())
 
     def get_captcha_info(self):
         import random
@@ -110,7 +200,11 @@ class RenrenMessage(object):
         self.client = client
         self.text = text
 
-    def publish(self, POST, FILES, form_prefix='backend'):
+    def publish(self, POST, FILES, form_prefix='backend', queue=False):
+        if queue and self.client.is_login_required():
+            # Don't make the publisher go through a failed submission and
+            # a captcha; owners will log in again when approving it.
+            return {'queued': True}
         url = self.client.get_url()
         form = None
 
@@ -123,6 +217,10 @@ class RenrenMessage(object):
             return form
 
         if url is None:
+            if queue:
+                # The session expired since the last keepalive run.
+                self.client.mark_login_required()
+                return {'queued': True}
             form = make_form()
             if not form.is_valid():
                 return {'forms': [form]}
@@ -136,9 +234,7 @@ class RenrenMessage(object):
         # url is not None now.
 
         def try_submit(url):
-            browser = self.client.make_browser()
-            browser.open(url)
-            browser.select_form(nr=0)
+            browser = self.client.check_session(url)
             browser['status'] = smart_bytes(self.text)
             browser.submit()
             if '%E7%8A%B6%E6%80%81%E5%8F%91%E5%B8%83%E6%88%90%E5%8A%9F' not in browser.geturl():
@@ -149,6 +245,9 @@ class RenrenMessage(object):
         except Exception:
             logging.warning('Renren initial submission error: ' + traceback.format_exc())
             # XXX: sometimes this is just a publishing error. Not a login error.
+            if queue:
+                self.client.mark_login_required()
+                return {'queued': True}
             if not form:
                 form = make_form()
                 if not form.is_valid():
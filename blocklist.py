@@ -0,0 +1,214 @@
+'''
+Per-service blocklists of user identifiers, addresses and networks.
+
+Entries are stored exactly in BlockedIdentifier. Each process keeps a
+Bloom filter of them, shared through the cache and reloaded only when its
+version changes, so a check costs one cache read plus a few hashes per
+candidate. The database is only asked to confirm a filter hit.
+
+The shared filter is only written under a per-service lock. A writer
+that can't get the lock marks the filter dirty instead, and the next
+check rebuilds it from the database.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+
+from multitreehole.models import BlockedIdentifier
+
+import hashlib
+import math
+import struct
+import threading
+import time
+import uuid
+
+# Bumped when the stored format changes.
+FILTER_CACHE_KEY = 'multitreehole_blocklist_filter2'
+LOCK_CACHE_KEY = 'multitreehole_blocklist_lock'
+DIRTY_CACHE_KEY = 'multitreehole_blocklist_dirty'
+LOCK_ATTEMPTS = 5
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+class BloomFilter(object):
+    '''
+    Also remembers the prefix lengths of the networks added, so checks
+    only try those.
+    '''
+    def __init__(self, capacity, error_rate=0.01, bits=None, count=0, prefixlens=()):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+        self.prefixlens = set(prefixlens)
+
+    def get_positions(self, value):
+        # Double hashing: k positions from one digest.
+        first, second = struct.unpack('<QQ', hashlib.md5(value.encode('utf-8')).digest())
+        return [(first + i * second) % self.size for i in xrange(self.hashes)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        if '/' in value:
+            self.prefixlens.add(int(value.rsplit('/', 1)[1]))
+
+    def __contains__(self, value):
+        for position in self.get_positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def dumps(self):
+        return (self.capacity, self.error_rate, str(self.bits), self.count, sorted(self.prefixlens))
+
+    @classmethod
+    def loads(cls, data):
+        capacity, error_rate, bits, count, prefixlens = data
+        return cls(capacity, error_rate, bits, count, prefixlens)
+
+def normalize(value):
+    '''
+    Networks are stored as network/prefix; anything else as given.
+    Raises ValueError for malformed networks.
+    '''
+    import ipaddr
+    value = value.strip()
+    if '/' in value:
+        return str(ipaddr.IPNetwork(value).masked())
+    return value
+
+def get_candidates(address, user_identifier, prefixlens):
+    '''
+    Values that would block this request: the identifier, the address
+    and the networks of the given prefix lengths containing the address.
+    '''
+    import ipaddr
+    candidates = [address]
+    if user_identifier:
+        candidates.append(user_identifier)
+    ip = ipaddr.IPAddress(address)
+    for prefixlen in prefixlens:
+        if prefixlen <= ip.max_prefixlen:
+            candidates.append(str(ipaddr.IPNetwork('%s/%d' % (address, prefixlen)).masked()))
+    return candidates
+
+def get_cache_key(service, prefix=FILTER_CACHE_KEY):
+    return ':'.join([prefix, str(service.pk)])
+
+def build(service):
+    values = list(BlockedIdentifier.objects.filter(service=service).values_list('value', flat=True))
+    bloom = BloomFilter(max(getattr(settings, 'MULTITREEHOLE_BLOCKLIST_MIN_CAPACITY', 1024), 2 * len(values)))
+    for value in values:
+        bloom.add(value)
+    return bloom
+
+def save(service, bloom):
+    # A fresh version, so processes never mistake an old filter for this one.
+    version = uuid.uuid4().hex
+    cache.set(get_cache_key(service), (version, bloom.dumps()), None)
+    with _filters_lock:
+        _filters[service.pk] = (version, bloom)
+
+def acquire_lock(service, attempts=1):
+    lock_key = get_cache_key(service, LOCK_CACHE_KEY)
+    for attempt in xrange(attempts):
+        if attempt:
+            time.sleep(0.05 * attempt)
+        if cache.add(lock_key, True, 60):
+            return True
+    return False
+
+def release_lock(service):
+    cache.delete(get_cache_key(service, LOCK_CACHE_KEY))
+
+def rebuild(service):
+    '''
+    Rebuilds the shared filter from the database. If another process holds
+    the lock, the filter is only built for the caller and the shared one
+    is left for a later check to rebuild.
+    '''
+    if not acquire_lock(service):
+        return build(service)
+    try:
+        # Cleared first: entries marked dirty from now on are rebuilt next time.
+        cache.delete(get_cache_key(service, DIRTY_CACHE_KEY))
+        bloom = build(service)
+        save(service, bloom)
+    finally:
+        release_lock(service)
+    return bloom
+
+def get_filter(service):
+    filter_key = get_cache_key(service)
+    dirty_key = get_cache_key(service, DIRTY_CACHE_KEY)
+    cached = cache.get_many([filter_key, dirty_key])
+    if filter_key not in cached or cached.get(dirty_key):
+        return rebuild(service)
+    version, data = cached[filter_key]
+    with _filters_lock:
+        local = _filters.get(service.pk)
+    if local and local[0] == version:
+        return local[1]
+    bloom = BloomFilter.loads(data)
+    with _filters_lock:
+        _filters[service.pk] = (version, bloom)
+    return bloom
+
+def is_blocked(service, address, user_identifier=None):
+    bloom = get_filter(service)
+    if not bloom.count:
+        return False
+    hits = [candidate for candidate in get_candidates(address, user_identifier, bloom.prefixlens)
+        if candidate in bloom]
+    if not hits:
+        return False
+    return BlockedIdentifier.objects.filter(service=service, value__in=hits).exists()
+
+def add(service, values):
+    '''
+    Adds entries and sets their bits in the shared filter.
+    Returns the number of new entries.
+    '''
+    values = set(normalize(value) for value in values if value.strip())
+    existing = set(BlockedIdentifier.objects.filter(
+        service=service, value__in=list(values)).values_list('value', flat=True))
+    new_values = values - existing
+    for value in new_values:
+        BlockedIdentifier.objects.create(service=service, value=value)
+    if not new_values:
+        return 0
+    if not acquire_lock(service, LOCK_ATTEMPTS):
+        # The lock holder may save a filter loaded before these rows existed.
+        cache.set(get_cache_key(service, DIRTY_CACHE_KEY), True, None)
+        return len(new_values)
+    try:
+        filter_key = get_cache_key(service)
+        dirty_key = get_cache_key(service, DIRTY_CACHE_KEY)
+        cached = cache.get_many([filter_key, dirty_key])
+        bloom = BloomFilter.loads(cached[filter_key][1]) \
+                if filter_key in cached and not cached.get(dirty_key) else None
+        if bloom is None or bloom.count + len(new_values) > bloom.capacity:
+            cache.delete(dirty_key)
+            bloom = build(service)
+        else:
+            for value in new_values:
+                bloom.add(value)
+        save(service, bloom)
+    finally:
+        release_lock(service)
+    return len(new_values)
+
+def remove(service, values):
+    '''
+    Removes entries. Their bits stay in the filter, which only costs extra
+    confirmation lookups, until add() rebuilds it for lack of capacity
+    (removed entries still count against it) or after a dirty mark.
+    '''
+    values = [normalize(value) for value in values if value.strip()]
+    BlockedIdentifier.objects.filter(service=service, value__in=values).delete()
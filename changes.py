@@ -0,0 +1,92 @@
+from django.conf import settings
+
+from multitreehole.models import Message
+
+from datetime import datetime, timedelta
+import base64
+import json
+
+CURSOR_PREFIX = 'at:'
+EPOCH = datetime(1970, 1, 1)
+
+def to_microseconds(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def get_message_key(message):
+    # Ids are only unique within a service once messages are sharded.
+    return '%s:%s' % (message.service_id, message.get_id())
+
+def encode_cursor(changed, seen):
+    '''
+    changed is a Message.changed value, or None for the beginning;
+    seen holds the keys of messages already returned at exactly changed.
+    '''
+    if changed is None:
+        value = [None, []]
+    else:
+        value = [to_microseconds(changed), sorted(seen)]
+    return base64.urlsafe_b64encode(CURSOR_PREFIX + json.dumps(value))
+
+def decode_cursor(cursor):
+    '''
+    Returns (changed, seen). Raises ValueError (or TypeError) for anything
+    encode_cursor() didn't produce.
+    '''
+    if not cursor:
+        return None, set()
+    value = base64.urlsafe_b64decode(str(cursor))
+    if not value.startswith(CURSOR_PREFIX):
+        raise ValueError('Malformed change feed cursor')
+    microseconds, seen = json.loads(value[len(CURSOR_PREFIX):])
+    if microseconds is None:
+        return None, set()
+    return EPOCH + timedelta(microseconds=long(microseconds)), set(seen)
+
+def get_changes(service, cursor, limit):
+    '''
+    Returns (messages, next cursor, has more) for messages saved after
+    cursor, in Message.changed order. service is None for all services.
+
+    The cursor is the last changed time returned plus the messages
+    returned at exactly that time, so saves sharing a timestamp are
+    neither repeated nor skipped. Changes newer than
+    MULTITREEHOLE_CHANGE_FEED_SETTLE seconds are held back so that a save
+    that took its timestamp earlier but committed later is not skipped.
+    Timestamps come from the saving app server's clock, so a server whose
+    clock lags by more than the settle window can have its saves skipped
+    for good: keep clocks synchronized, or raise the setting above the
+    worst skew.
+
+    Messages saved before Message.changed existed only appear once
+    multitreehole_backfill_changed has run.
+    '''
+    changed, seen = decode_cursor(cursor)
+    if service is None:
+        queryset = Message.all_services()
+    else:
+        queryset = Message.filter_service(service)
+    if changed is not None:
+        queryset = queryset.filter(changed__gte=changed)
+    else:
+        queryset = queryset.filter(changed__isnull=False)
+    queryset = queryset.order_by('changed')
+    settled = datetime.now() - timedelta(
+        seconds=getattr(settings, 'MULTITREEHOLE_CHANGE_FEED_SETTLE', 5))
+    messages = []
+    # Messages already seen come first, so fetching that many more always
+    # leaves room for new ones.
+    for message in queryset[:limit + len(seen)]:
+        if message.changed > settled:
+            break
+        key = get_message_key(message)
+        if message.changed == changed and key in seen:
+            continue
+        messages.append(message)
+        if message.changed != changed:
+            changed = message.changed
+            seen = set()
+        seen.add(key)
+        if len(messages) == limit:
+            break
+    return messages, encode_cursor(changed, seen), len(messages) == limit
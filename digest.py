@@ -0,0 +1,131 @@
+'''
+Digest mode: accepted messages are buffered and published together.
+
+Enabled per service with a "digest" object in Service.params:
+
+    "digest": {"window": 600, "max_length": 140, "separator": "\\n"}
+
+Buffered messages are open ("closed" unset) and approved, with no
+backend yet. They go out as one backend post when the buffer reaches the
+length limit (the smaller of "max_length" and the backend's max_length)
+or the oldest one has waited "window" seconds. A digest the backend
+doesn't publish, or a message too long on its own, goes to moderation.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+
+from multitreehole.models import Message
+from multitreehole.utils import get_client, load_backend
+from multitreehole import rollups
+
+from datetime import datetime, timedelta
+import json
+import logging
+import traceback
+import uuid
+
+LOCK_CACHE_KEY = 'multitreehole_digest_lock'
+
+def get_params(service):
+    return service.get_params().get('digest')
+
+def get_max_length(service, params):
+    # Clients may be configured with their own limit (e.g. "max-length").
+    client_limit = getattr(get_client(service.backend), 'max_length', None)
+    limits = [limit for limit in (
+        params.get('max_length'),
+        client_limit or getattr(load_backend(service.backend.path), 'max_length', None),
+    ) if limit]
+    return min(limits) if limits else None
+
+def get_buffered(service):
+    return Message.filter_service(service).filter(closed=False, approved=True).order_by('timestamp')
+
+def buffer(message):
+    '''
+    Marks an accepted message as waiting for the next digest.
+    '''
+    message.closed = False
+    message.approved = True
+
+def make_chunks(messages, max_length, separator):
+    '''
+    Splits messages into groups whose joined text fits in max_length.
+    A message too long on its own gets a group of its own.
+    '''
+    chunks = []
+    chunk = []
+    length = 0
+    for message in messages:
+        added = len(message.text) + (len(separator) if chunk else 0)
+        if chunk and max_length and length + added > max_length:
+            chunks.append(chunk)
+            chunk = []
+            added = len(message.text)
+            length = 0
+        chunk.append(message)
+        length += added
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def moderate(service, chunk):
+    for message in chunk:
+        message.closed = False
+        message.approved = None
+        message.save()
+    rollups.record(service, rollups.PENDING, delta=len(chunk))
+
+def flush(service, force=False):
+    '''
+    Publishes every full digest, and the last partial one if it is due.
+    Returns the number of messages published; the rest of the flushed
+    messages went to moderation.
+    '''
+    params = get_params(service)
+    if not params or not service.backend:
+        return 0
+    lock_key = ':'.join([LOCK_CACHE_KEY, str(service.pk)])
+    if not cache.add(lock_key, True, getattr(settings, 'MULTITREEHOLE_DIGEST_LOCK_TIMEOUT', 60)):
+        # Another request is flushing this service.
+        return 0
+    try:
+        messages = list(get_buffered(service)[:getattr(settings, 'MULTITREEHOLE_DIGEST_BATCH_SIZE', 200)])
+        if not messages:
+            return 0
+        separator = params.get('separator', '\n')
+        max_length = get_max_length(service, params)
+        chunks = make_chunks(messages, max_length, separator)
+        window = timedelta(seconds=params.get('window', 600))
+        if not force and messages[0].timestamp > datetime.now() - window:
+            # The last chunk may still grow.
+            chunks = chunks[:-1]
+        published = 0
+        client = get_client(service.backend)
+        for chunk in chunks:
+            text = separator.join(message.text for message in chunk)
+            if max_length and len(text) > max_length:
+                # A single message too long to ever be published.
+                moderate(service, chunk)
+                continue
+            try:
+                status = client.make_message(text).publish({}, {}, form_prefix='digest', queue=True)
+            except Exception:
+                logging.warning('Digest publishing error: ' + traceback.format_exc())
+                status = {}
+            if 'data' not in status:
+                # Retrying would block every later digest; let owners decide.
+                logging.warning('Digest for service %s not published: %r' % (service.slug, status.keys()))
+                moderate(service, chunk)
+                continue
+            backend_data = json.dumps({'digest': uuid.uuid4().hex, 'data': status['data']})
+            for message in chunk:
+                message.closed = True
+                message.backend = service.backend
+                message.backend_data = backend_data
+                message.save()
+            published += len(chunk)
+        return published
+    finally:
+        cache.delete(lock_key)
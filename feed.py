@@ -0,0 +1,141 @@
+'''
+Fan-out hub for live moderation feeds.
+
+Every message save appends an event to a per-service sequence kept in the
+cache. Open feeds only watch the sequence number, and a process shares
+one cache read per service and poll interval between all its waiting
+requests, so moderator tabs don't turn into database polling. The
+database is only queried to resynchronize when events have expired.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+
+from datetime import datetime
+import threading
+import time
+
+SEQ_CACHE_KEY = 'multitreehole_feed_seq'
+EVENT_CACHE_KEY = 'multitreehole_feed_event'
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+_local_seqs = {}
+_local_lock = threading.Lock()
+
+def get_interval():
+    return getattr(settings, 'MULTITREEHOLE_FEED_INTERVAL', 1)
+
+def get_seq_key(service_pk):
+    return ':'.join([SEQ_CACHE_KEY, str(service_pk)])
+
+def get_event_key(service_pk, seq):
+    return ':'.join([EVENT_CACHE_KEY, str(service_pk), str(seq)])
+
+def make_event(message):
+    return {
+        'id': message.get_id(),
+        'timestamp': message.timestamp.strftime(TIMESTAMP_FORMAT),
+        'user_identifier': message.user_identifier,
+        'text': message.text,
+        'closed': message.closed,
+        'approved': message.approved,
+    }
+
+def notify(message):
+    key = get_seq_key(message.service_id)
+    cache.add(key, 0, None)
+    try:
+        seq = cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr(); older cursors will resync.
+        seq = 1
+        cache.set(key, seq, None)
+    cache.set(get_event_key(message.service_id, seq), make_event(message),
+        getattr(settings, 'MULTITREEHOLE_FEED_EVENT_TIMEOUT', 3600))
+
+def get_seq(service):
+    '''
+    Current sequence number. Cached in-process for one poll interval.
+    '''
+    now = time.time()
+    with _local_lock:
+        checked, seq = _local_seqs.get(service.pk, (0, None))
+    if now - checked < get_interval():
+        return seq
+    seq = cache.get(get_seq_key(service.pk)) or 0
+    with _local_lock:
+        _local_seqs[service.pk] = (now, seq)
+    return seq
+
+def make_cursor(seq, timestamp=None, id=None):
+    if timestamp is None:
+        return str(seq)
+    return '%d-%s-%s' % (seq, timestamp, id)
+
+def parse_cursor(cursor):
+    '''
+    Returns (seq, timestamp string or None, id or None); raises ValueError.
+    '''
+    pieces = cursor.split('-')
+    if len(pieces) == 1:
+        return int(pieces[0]), None, None
+    seq, timestamp, id = pieces
+    datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    return int(seq), timestamp, long(id)
+
+def get_events(service, since, seq):
+    '''
+    Events after since, up to seq. Returns None if some have expired.
+    '''
+    if seq < since:
+        # The sequence was reset.
+        return None
+    limit = getattr(settings, 'MULTITREEHOLE_FEED_MAX_EVENTS', 100)
+    keys = [get_event_key(service.pk, i) for i in xrange(since + 1, seq + 1)]
+    if len(keys) > limit:
+        return None
+    found = cache.get_many(keys)
+    if len(found) != len(keys):
+        return None
+    return [found[key] for key in keys]
+
+def resync(service, timestamp, id):
+    '''
+    Pending messages after (timestamp, id), straight from the database.
+    '''
+    from multitreehole.models import Message
+    queryset = Message.filter_service(service).filter(closed=False)
+    if timestamp is not None:
+        queryset = queryset.filter(timestamp__gte=datetime.strptime(timestamp, TIMESTAMP_FORMAT))
+    limit = getattr(settings, 'MULTITREEHOLE_FEED_MAX_EVENTS', 100)
+    events = []
+    for message in queryset.order_by('timestamp')[:limit]:
+        event = make_event(message)
+        if timestamp is not None and (event['timestamp'], event['id']) <= (timestamp, id):
+            continue
+        events.append(event)
+    return events
+
+def poll(service, cursor, timeout):
+    '''
+    Waits up to timeout seconds for changes after cursor.
+
+    Returns (events, new cursor, resynced). When resynced is true, events
+    only cover pending messages and earlier state changes may be missing.
+    '''
+    since, timestamp, id = parse_cursor(cursor)
+    deadline = time.time() + timeout
+    seq = get_seq(service)
+    while seq == since and time.time() < deadline:
+        time.sleep(get_interval())
+        seq = get_seq(service)
+    if seq == since:
+        return [], cursor, False
+    events = get_events(service, since, seq)
+    resynced = events is None
+    if resynced:
+        events = resync(service, timestamp, id)
+    for event in events:
+        if (event['timestamp'], event['id']) > (timestamp, id):
+            timestamp, id = event['timestamp'], event['id']
+    return events, make_cursor(seq, timestamp, id), resynced
@@ -2,6 +2,9 @@ from django import forms
 from django.core.exceptions import ValidationError
 
 import json
+import re
+
+TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
 
 def validate_json(value):
     try:
@@ -9,11 +12,28 @@ def validate_json(value):
     except ValueError, e:
         raise ValidationError(e.message)
 
+def validate_access_patterns(value):
+    from multitreehole.patterns import check_pattern, UnsafePattern
+    try:
+        params = json.loads(value)
+    except ValueError:
+        # Reported by validate_json.
+        return
+    if not isinstance(params, dict):
+        return
+    for access in params.get('access', []):
+        for key in ('reject', 'moderate'):
+            if key in access:
+                try:
+                    check_pattern(access[key])
+                except UnsafePattern, e:
+                    raise ValidationError('"%s" pattern %s: %s' % (key, access[key], e.message))
+
 class ServiceForm(forms.Form):
     label = forms.CharField(max_length=255)
     params = forms.CharField(
         widget=forms.Textarea,
-        validators=[validate_json],
+        validators=[validate_json, validate_access_patterns],
         initial=json.dumps({
             'access': [
                 {
@@ -28,3 +48,32 @@ class ServiceForm(forms.Form):
 
 class PublishForm(forms.Form):
     text = forms.CharField(widget=forms.Textarea)
+    # Identifies one submission, so retries of it are recognized.
+    token = forms.CharField(widget=forms.HiddenInput, required=False)
+
+    def __init__(self, *args, **kwargs):
+        import uuid
+        kwargs.setdefault('initial', {}).setdefault('token', uuid.uuid4().hex)
+        super(PublishForm, self).__init__(*args, **kwargs)
+
+    def clean_token(self):
+        # It goes into a cache key. Anything but a uuid4().hex is dropped,
+        # which only costs the retry protection of a forged token.
+        token = self.cleaned_data['token']
+        if not TOKEN_RE.match(token):
+            return ''
+        return token
+
+def validate_blocklist_entries(value):
+    from multitreehole.blocklist import normalize
+    for line in value.splitlines():
+        try:
+            entry = normalize(line)
+        except ValueError, e:
+            raise ValidationError(e.message)
+        if len(entry) > 255:
+            raise ValidationError('Entry too long: %s' % entry[:32])
+
+class BlocklistForm(forms.Form):
+    add = forms.CharField(widget=forms.Textarea, required=False, validators=[validate_blocklist_entries])
+    remove = forms.CharField(widget=forms.Textarea, required=False, validators=[validate_blocklist_entries])
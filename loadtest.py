@@ -0,0 +1,299 @@
+'''
+Load generator for a multi-tenant deployment.
+
+Creates many throwaway services, then drives PublishView and
+MessageListView through Service.split_request_host routing with
+concurrent publishers (from many addresses) and moderators. Requests are
+built with RequestFactory and passed straight to the views, so no URLconf
+or middleware is involved. Run it through the multitreehole_loadtest
+management command against a disposable database.
+'''
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.db import connection
+from django.test.client import RequestFactory
+
+from multitreehole import rollups
+from multitreehole.models import Backend, Service, Message
+from multitreehole.utils import load_backend
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import traceback
+
+SLUG_PREFIX = 'loadtest-'
+RENREN_PUBLISHED_QUERY = 'msg=%E7%8A%B6%E6%80%81%E5%8F%91%E5%B8%83%E6%88%90%E5%8A%9F'
+
+ACCESS_PROFILES = [
+    [{'network': '0.0.0.0/0'}],
+    [{'network': '0.0.0.0/0', 'throttle': 60, 'suffixlen': 8}],
+    [{'network': '0.0.0.0/0', 'moderate': r'spam|\d{4}'}],
+    [{'network': '10.0.0.0/8', 'reject': 'badword', 'throttle': 10}],
+    [
+        {'network': '192.168.0.0/16', 'moderate': '.'},
+        {'network': '0.0.0.0/0', 'throttle': 30, 'suffixlen': 16},
+    ],
+]
+
+WORDS = ['hello', 'tree', 'hole', 'spam', 'badword', 'exam', 'library', 'canteen', '2013']
+
+class StandInRenrenHandler(BaseHTTPRequestHandler):
+    '''
+    Just enough of 3g.renren.com for RenrenClient: login, profile and status forms.
+    '''
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers=()):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/profile.do'):
+            self.reply('<html><body><form method="post" action="/status">'
+                '<textarea name="status"></textarea></form></body></html>')
+        elif self.path.startswith('/home.do'):
+            self.reply('<html><body>ok</body></html>')
+        else:
+            self.reply('<html><body><form method="post" action="/login">'
+                '<input name="email"><input name="password" type="password">'
+                '<input type="hidden" name="verifykey" value="key">'
+                '<input name="verifycode"></form></body></html>')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        if self.path.startswith('/login'):
+            self.reply('<html><body><a href="/profile.do?id=1">me</a></body></html>')
+        elif self.path.startswith('/status'):
+            with self.server.lock:
+                self.server.published += 1
+            self.reply('', 302, [('Location', '/home.do?' + RENREN_PUBLISHED_QUERY)])
+        else:
+            self.reply('', 404)
+
+class StandInRenrenServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInRenrenHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.published = 0
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.queries = {}
+        self.outcomes = {}
+        self.errors = {}
+
+    def add(self, operation, latency, queries, outcome):
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(latency)
+            self.queries.setdefault(operation, []).append(queries)
+            key = (operation, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def add_error(self, operation, error):
+        with self.lock:
+            key = (operation, error)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class LoadTest(object):
+    def __init__(self, services=1000, publishers=20, moderators=4,
+            duration=60, domain='loadtest.local', renren_latency=0, seed=None):
+        self.service_count = services
+        self.publisher_count = publishers
+        self.moderator_count = moderators
+        self.duration = duration
+        self.domain = domain
+        self.random = random.Random(seed)
+        self.renren = StandInRenrenServer(renren_latency)
+        self.factory = RequestFactory()
+        self.stats = Stats()
+        self.services = []
+        self.backends = []
+        self.meta = None
+        self.log_dir = tempfile.mkdtemp(prefix='multitreehole-loadtest-')
+
+    def setup(self):
+        self.renren.start()
+        self.moderator, created = User.objects.get_or_create(username='multitreehole-loadtest')
+        if created or not self.moderator.is_superuser:
+            self.moderator.is_superuser = True
+            self.moderator.save()
+        if not Service.objects.filter(backend__isnull=True).exists():
+            # login_required looks up the meta site for its login URL.
+            self.meta = Service(slug='%smeta' % SLUG_PREFIX, backend=None)
+            self.meta.label = self.meta.slug
+            self.meta.save()
+        for i in xrange(self.service_count):
+            backend = Backend()
+            if i % 2:
+                backend.path = 'multitreehole.backends.renren.RenrenBackend'
+                backend.params = json.dumps({
+                    'username': 'loadtest', 'password': 'loadtest',
+                    'base-url': self.renren.base_url,
+                })
+            else:
+                backend.path = 'multitreehole.backends.localfile.LocalFileBackend'
+                backend.params = json.dumps({
+                    'file-name': os.path.join(self.log_dir, '%d.txt' % i),
+                })
+            backend.save()
+            if i % 2:
+                # Skip the captcha: pretend an owner has already logged in.
+                client = load_backend(backend.path).make_client(backend.pk, backend.params)
+                cache.set(client.get_cache_key(), self.renren.base_url + '/profile.do?id=1',
+                    getattr(settings, 'MULTITREEHOLE_BACKEND_RENREN_LOGIN_CACHE_TIMEOUT'))
+            service = Service(slug='%s%d' % (SLUG_PREFIX, i))
+            service.label = service.slug
+            service.params = json.dumps({'access': self.random.choice(ACCESS_PROFILES)})
+            service.backend = backend
+            service.owners.add(self.moderator.pk)
+            service.save()
+            self.backends.append(backend)
+            self.services.append(service)
+
+    def teardown(self):
+        self.renren.shutdown()
+        for service in self.services:
+            # Also deletes its messages, wherever they live.
+            service.delete()
+        for backend in self.backends:
+            backend.delete()
+        if self.meta is not None:
+            self.meta.delete()
+
+    def make_address(self):
+        if self.random.random() < 0.8:
+            return '10.%d.%d.%d' % tuple(self.random.randrange(256) for i in range(3))
+        return '192.168.%d.%d' % tuple(self.random.randrange(256) for i in range(2))
+
+    def make_text(self):
+        return ' '.join(self.random.choice(WORDS) for i in range(self.random.randint(1, 12)))
+
+    def timed(self, operation, view, request):
+        connection.use_debug_cursor = True
+        queries_before = len(connection.queries)
+        start = time.time()
+        try:
+            response = view(request)
+            if hasattr(response, 'render'):
+                response.render()
+        except Exception, e:
+            self.stats.add_error(operation, e.__class__.__name__)
+            if self.stats.errors[(operation, e.__class__.__name__)] == 1:
+                traceback.print_exc()
+            return None
+        finally:
+            latency = time.time() - start
+            queries = len(connection.queries) - queries_before
+        self.stats.add(operation, latency, queries, response.status_code)
+        return response
+
+    def make_request(self, method, service, address, user, path='/', data=None):
+        request = getattr(self.factory, method)(path, data or {},
+            HTTP_HOST=service.slug + '.' + self.domain,
+            REMOTE_ADDR=address,
+        )
+        request.user = user
+        return request
+
+    def publisher(self, deadline):
+        from multitreehole.views import main
+        while time.time() < deadline:
+            service = self.random.choice(self.services)
+            request = self.make_request('post', service, self.make_address(), AnonymousUser(),
+                data={'text': self.make_text()})
+            self.timed('publish', main, request)
+
+    def moderator_loop(self, deadline):
+        from multitreehole.views import MessageListView
+        view = MessageListView.as_view()
+        while time.time() < deadline:
+            service = self.random.choice(self.services)
+            request = self.make_request('get', service, '127.0.0.1', self.moderator,
+                data={'closed': 'False'})
+            self.timed('moderate-list', view, request)
+            pending = [str(message.get_id()) for message in
+                Message.filter_service(service).filter(closed=False)[:20]]
+            if not pending:
+                continue
+            request = self.make_request('post', service, '127.0.0.1', self.moderator,
+                data={'message': pending, 'batch_approve': '1'})
+            self.timed('moderate-approve', view, request)
+
+    def run(self):
+        deadline = time.time() + self.duration
+        threads = [threading.Thread(target=self.publisher, args=(deadline,))
+            for i in range(self.publisher_count)]
+        threads += [threading.Thread(target=self.moderator_loop, args=(deadline,))
+            for i in range(self.moderator_count)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+
+    def report(self):
+        lines = ['%d services, %d publishers, %d moderators, %.1fs' % (
+            self.service_count, self.publisher_count, self.moderator_count, self.elapsed)]
+        lines.append('%-18s %8s %8s %8s %8s %8s %8s' % (
+            'operation', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'queries'))
+        for operation, latencies in sorted(self.stats.latencies.iteritems()):
+            queries = self.stats.queries[operation]
+            lines.append('%-18s %8d %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+                operation, len(latencies), len(latencies) / self.elapsed,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.9) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                float(sum(queries)) / len(queries),
+            ))
+        lines.append('outcomes:')
+        for (operation, outcome), count in sorted(self.stats.outcomes.iteritems()):
+            lines.append('  %s %s: %d' % (operation, outcome, count))
+        lines.append('activity (from rollups):')
+        kinds = {}
+        for service in self.services:
+            for (service_id, user_identifier, kind), count in \
+                    rollups.get_hourly_totals(service, 1).iteritems():
+                kinds[kind] = kinds.get(kind, 0) + count
+        for kind, count in sorted(kinds.iteritems()):
+            lines.append('  %s: %d' % (kind, count))
+        lines.append('errors:')
+        for (operation, error), count in sorted(self.stats.errors.iteritems()):
+            lines.append('  %s %s: %d' % (operation, error, count))
+        lines.append('stand-in Renren statuses published: %d' % self.renren.published)
+        return '\n'.join(lines)
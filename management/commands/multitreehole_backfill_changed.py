@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from multitreehole.models import Message, Service
+
+class Command(BaseCommand):
+    args = '[slug ...]'
+    help = 'Sets Message.changed to the message timestamp where it is missing, so the change feed covers old messages.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Messages updated per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        services = Service.objects.exclude(backend__isnull=True)
+        if args:
+            services = services.filter(slug__in=args)
+        for service in services:
+            updated = 0
+            while True:
+                batch = list(Message.filter_service(service).filter(
+                    changed__isnull=True)[:options['batch_size']])
+                if not batch:
+                    break
+                for message in batch:
+                    # update() rather than save(), which would stamp the current time.
+                    Message.filter_service(service).filter(pk=message.pk).update(
+                        changed=message.timestamp)
+                updated += len(batch)
+            self.stdout.write('%s %d\n' % (service.slug, updated))
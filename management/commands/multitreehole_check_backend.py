@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from multitreehole.backends.contract import make_suite, MEMORY_BACKEND_PATH, MEMORY_CONFIGS
+
+import json
+import sys
+import unittest
+
+class Command(BaseCommand):
+    args = '[backend-path [params-json]]'
+    help = 'Runs the tree hole backend contract suite against a backend.'
+
+    def handle(self, *args, **options):
+        suite = unittest.TestSuite()
+        if args:
+            params = args[1] if len(args) > 1 else '{}'
+            try:
+                json.loads(params)
+            except ValueError, e:
+                raise CommandError('Invalid params: %s' % e)
+            suite.addTests(make_suite(args[0], params))
+        else:
+            # Every kind of publish outcome of the stand-in is checked.
+            for i, config in enumerate(MEMORY_CONFIGS):
+                suite.addTests(make_suite(MEMORY_BACKEND_PATH, json.dumps(config), backend_pk=-1 - i))
+        result = unittest.TextTestRunner(stream=sys.stderr, verbosity=int(options.get('verbosity', 1))).run(suite)
+        if not result.wasSuccessful():
+            raise CommandError('Backend contract violated.')
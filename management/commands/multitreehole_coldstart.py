@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+import json
+import os
+import subprocess
+import sys
+
+# Runs in a fresh interpreter, like the first request of a new instance.
+PROBE = '''
+import json, sys, time
+start = time.time()
+from django.conf import settings
+settings.INSTALLED_APPS
+settings_time = time.time()
+import multitreehole.views
+views_time = time.time()
+from multitreehole.utils import get_backends, get_backend_or_404
+backends = get_backends()
+backends_time = time.time()
+for backend in backends:
+    get_backend_or_404(backend.slug)
+lookup_time = time.time()
+print json.dumps({
+    'settings': settings_time - start,
+    'views': views_time - settings_time,
+    'backends': backends_time - views_time,
+    'slug lookups': lookup_time - backends_time,
+    'total': lookup_time - start,
+    'mechanize loaded': 'mechanize' in sys.modules,
+})
+'''
+
+class Command(BaseCommand):
+    help = 'Measures cold-start cost of importing views and loading tree hole backends.'
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', type='int', default=10,
+            help='Fresh interpreters to start.'),
+    )
+
+    def handle(self, *args, **options):
+        runs = []
+        for i in range(options['runs']):
+            output = subprocess.check_output([sys.executable, '-c', PROBE], env=os.environ.copy())
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        for key in ('settings', 'views', 'backends', 'slug lookups', 'total'):
+            values = sorted(run[key] for run in runs)
+            self.stdout.write('%-14s median %8.2f ms  max %8.2f ms\n' % (
+                key, values[len(values) // 2] * 1000, values[-1] * 1000))
+        self.stdout.write('mechanize imported at startup: %s\n' % any(run['mechanize loaded'] for run in runs))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from multitreehole import digest
+from multitreehole.models import Service
+
+class Command(BaseCommand):
+    help = 'Publishes buffered digest messages whose window has passed.'
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False,
+            help='Publish partial digests even if their window has not passed.'),
+    )
+
+    def handle(self, *args, **options):
+        for service in Service.objects.exclude(backend__isnull=True):
+            if not digest.get_params(service):
+                continue
+            published = digest.flush(service, force=options['force'])
+            if published:
+                self.stdout.write('%s %d\n' % (service.slug, published))
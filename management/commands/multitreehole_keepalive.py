@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from multitreehole.models import Backend
+from multitreehole.utils import get_client
+
+import logging
+import traceback
+
+class Command(BaseCommand):
+    help = 'Validates and extends cached backend sessions; alerts owners when a login is needed.'
+
+    def handle(self, *args, **options):
+        for backend in Backend.objects.all():
+            try:
+                client = get_client(backend)
+            except Exception:
+                logging.warning('Keepalive client error for backend %s: %s' % (backend.pk, traceback.format_exc()))
+                continue
+            if not hasattr(client, 'keepalive'):
+                continue
+            status = client.keepalive()
+            self.stdout.write('%s %s\n' % (backend.pk, status))
+            if status != 'ok':
+                client.alert_owners(status)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from multitreehole.loadtest import LoadTest
+
+class Command(BaseCommand):
+    help = 'Runs a multi-tenant load test. Creates and deletes data: use a disposable database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--services', type='int', default=1000),
+        make_option('--publishers', type='int', default=20,
+            help='Concurrent publisher threads.'),
+        make_option('--moderators', type='int', default=4,
+            help='Concurrent moderator threads doing batch approvals.'),
+        make_option('--duration', type='float', default=60,
+            help='Seconds to generate load for.'),
+        make_option('--domain', default='loadtest.local',
+            help='Host suffix after the service slug.'),
+        make_option('--renren-latency', type='float', default=0,
+            help='Seconds the stand-in Renren server waits per response.'),
+        make_option('--seed', type='int', default=None),
+        make_option('--keep', action='store_true', default=False,
+            help='Keep the created services and messages.'),
+    )
+
+    def handle(self, *args, **options):
+        test = LoadTest(
+            services=options['services'],
+            publishers=options['publishers'],
+            moderators=options['moderators'],
+            duration=options['duration'],
+            domain=options['domain'],
+            renren_latency=options['renren_latency'],
+            seed=options['seed'],
+        )
+        test.setup()
+        try:
+            test.run()
+            self.stdout.write(test.report() + '\n')
+        finally:
+            if not options['keep']:
+                test.teardown()
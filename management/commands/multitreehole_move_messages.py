@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from optparse import make_option
+
+from multitreehole.models import Message, Service
+from multitreehole.routers import get_message_database, get_message_databases
+
+class Command(BaseCommand):
+    args = '[slug alias]'
+    help = ('Without arguments, records the message database of every service that has none yet; '
+        'run it before changing MULTITREEHOLE_MESSAGE_DATABASES. With a slug and an alias, '
+        'moves the service\'s messages there; run it again a minute later to move messages '
+        'written meanwhile by processes that still had the old alias.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Messages copied per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        aliases = get_message_databases()
+        if not aliases:
+            raise CommandError('MULTITREEHOLE_MESSAGE_DATABASES is not set.')
+        if not args:
+            for service in Service.objects.using('default').exclude(backend__isnull=True):
+                self.stdout.write('%s %s\n' % (service.slug, get_message_database(service)))
+            return
+        if len(args) != 2:
+            raise CommandError('Give a service slug and a database alias.')
+        slug, alias = args
+        if alias not in aliases:
+            raise CommandError('%s is not in MULTITREEHOLE_MESSAGE_DATABASES.' % alias)
+        try:
+            service = Service.objects.using('default').get(slug=slug)
+        except Service.DoesNotExist:
+            raise CommandError('No service %s.' % slug)
+        # New messages go to the new alias from now on.
+        Service.objects.using('default').filter(pk=service.pk).update(message_database=alias)
+        moved = 0
+        for source in aliases:
+            if source == alias:
+                continue
+            while True:
+                batch = list(Message.objects.using(source).filter(service=service)
+                    .order_by('pk')[:options['batch_size']])
+                if not batch:
+                    break
+                pks = [message.pk for message in batch]
+                # Copied by an interrupted run already.
+                copied = set(Message.objects.using(alias).filter(
+                    service=service, pk__in=pks).values_list('pk', flat=True))
+                try:
+                    # bulk_create keeps ids (they appear in URLs) and
+                    # bypasses Message.save(), which would restamp changed.
+                    Message.objects.using(alias).bulk_create(
+                        [message for message in batch if message.pk not in copied])
+                except IntegrityError:
+                    raise CommandError('Message ids %d to %d of %s are taken on %s; nothing '
+                        'of this batch was deleted.' % (pks[0], pks[-1], slug, alias))
+                Message.objects.using(source).filter(pk__in=pks).delete()
+                moved += len(batch)
+        self.stdout.write('%s %s %d\n' % (slug, alias, moved))
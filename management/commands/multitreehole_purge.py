@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from multitreehole.models import Service
+from multitreehole.retention import purge_service
+
+class Command(BaseCommand):
+    args = '[slug ...]'
+    help = 'Deletes messages past each service\'s "retention" period, in bounded batches.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Messages deleted per batch.'),
+        make_option('--pause', type='float', default=0.5,
+            help='Seconds to sleep between batches.'),
+        make_option('--max-batches', type='int', default=None,
+            help='Stop after this many batches per service; the next run resumes.'),
+    )
+
+    def handle(self, *args, **options):
+        services = Service.objects.exclude(backend__isnull=True)
+        if args:
+            services = services.filter(slug__in=args)
+        for service in services:
+            deleted = purge_service(service,
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                max_batches=options['max_batches'],
+            )
+            self.stdout.write('%s %d\n' % (service.slug, deleted))
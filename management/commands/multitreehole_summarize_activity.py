@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from multitreehole import rollups
+
+class Command(BaseCommand):
+    help = 'Folds per-identifier activity counters of completed hours into bounded top lists.'
+
+    def handle(self, *args, **options):
+        hours = rollups.summarize()
+        self.stdout.write('%d\n' % hours)
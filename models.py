@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.cache import cache
 from django.db import models
 from django.http import Http404
 
@@ -30,6 +30,8 @@ class Service(models.Model):
     backend = models.ForeignKey(Backend, null=True)
     params = models.TextField()
     owners = SetField(models.ForeignKey(User))
+    # Alias holding this service's messages; see multitreehole.routers.
+    message_database = models.CharField(max_length=64, blank=True)
     if use_ancestor:
         key = DbKeyField(primary_key=True)
 
@@ -90,63 +92,45 @@ class Service(models.Model):
         The second is user identifier as a string.
         Usually this is user IP with last bits cleared.
 
-        The third is a "confirm" function. Call it after a message is placed
-        to confirm access (for throttling).
+        The third is an AccessConfirmation. Call it before a message is
+        placed to reserve the user's throttle slot; it returns False if the
+        slot is taken. Call its release() if the message is not placed.
         '''
+        from multitreehole import blocklist
         for access in self.get_params().get('access', []):
             access_level, user_identifier, confirm = self.match_access(access, request)
             if access_level != 'reject':
+                if blocklist.is_blocked(self, request.META['REMOTE_ADDR'], user_identifier):
+                    return 'reject', user_identifier, AccessConfirmation()
                 if text is None or access_level == 'throttle':
                     return access_level, user_identifier, confirm
                 else:
-                    if 'reject' in access:
-                        reject_re = re.compile(access['reject'])
-                        if reject_re.search(text):
-                            return 'reject', user_identifier, confirm
-                    if 'moderate' in access:
-                        moderate_re = re.compile(access['moderate'])
-                        if moderate_re.search(text):
-                            return 'moderate', user_identifier, confirm
+                    from multitreehole import patterns
+                    budget = patterns.Budget()
+                    for pattern_level in ('reject', 'moderate'):
+                        if pattern_level in access:
+                            matched = patterns.search(access[pattern_level], text, budget)
+                            if matched is None:
+                                # Not safe to decide in time; let owners do it.
+                                return 'moderate', user_identifier, confirm
+                            if matched:
+                                return pattern_level, user_identifier, confirm
                     # access_level should be 'accept' here.
                     return access_level, user_identifier, confirm
-        return 'reject', None, lambda obj: True
+        return 'reject', None, AccessConfirmation()
 
     def match_access(self, access, request):
         '''
         Returns 'accept', 'throttle' or 'reject',
         plus the user identifier mentioned above.
         '''
-        from datetime import datetime, timedelta
         user_identifier = self.extract_user_identifier(access, request)
-        confirm = lambda obj: True
+        confirm = AccessConfirmation()
         if user_identifier:
             throttle = access.get('throttle')
             if throttle:
-                delta = timedelta(seconds=throttle)
-                threshold = datetime.now() - delta
-                def confirm(obj=None):
-                    try:
-                        existing = Message.filter_service(self).get(
-                            user_identifier=user_identifier,
-                            timestamp__gt=threshold,
-                        )
-                    except ObjectDoesNotExist:
-                        if obj:
-                            # Shouldn't happen
-                            raise Exception('Expected message object is missing when confirming throttling')
-                        else:
-                            return True
-                    except MultipleObjectsReturned:
-                        return False
-                    # existing is returned
-                    if obj:
-                        if existing != obj:
-                            raise Exception('Expected message object is not returned when confirming throttling')
-                        else:
-                            return True
-                    else:
-                        return False
-                if not confirm():
+                confirm = ThrottleConfirmation(self, user_identifier, throttle)
+                if confirm.is_throttled():
                     return 'throttle', user_identifier, confirm
             return 'accept', user_identifier, confirm
         return 'reject', user_identifier, confirm
@@ -163,15 +147,93 @@ class Service(models.Model):
             return str(subnet.network)
         return None
 
+    def get_retention_threshold(self):
+        '''
+        Messages older than the returned datetime may be purged.
+        Returns None if the service keeps messages forever.
+        '''
+        from datetime import datetime, timedelta
+        retention = self.get_params().get('retention')
+        if not retention:
+            return None
+        return datetime.now() - timedelta(seconds=retention)
+
     def is_owner(self, user):
         # Must be request.user.pk
         return user.pk in self.owners or user.is_superuser
 
+    def delete(self, *args, **kwargs):
+        # Messages may live on another database than the service, so they
+        # are not cascaded (see Message.service); bulk deletes of services
+        # must do the same.
+        Message.filter_service(self).delete()
+        super(Service, self).delete(*args, **kwargs)
+
     def __unicode__(self):
         return self.label
 
+class AccessConfirmation(object):
+    '''
+    Access confirmation for unthrottled access.
+    '''
+    def __call__(self):
+        return True
+
+    def release(self):
+        pass
+
+class ThrottleConfirmation(AccessConfirmation):
+    '''
+    Reserves a throttle slot with an atomic cache add, so concurrent
+    requests can't both pass without a throwaway message being written.
+    Messages already placed within the window are still found in the
+    database, so losing the cache only weakens the concurrent case.
+    '''
+    RESERVATION_CACHE_KEY = 'multitreehole_throttle'
+
+    def __init__(self, service, user_identifier, throttle):
+        self.service = service
+        self.user_identifier = user_identifier
+        self.throttle = throttle
+        self.reserved = False
+
+    def get_cache_key(self):
+        return ':'.join([self.RESERVATION_CACHE_KEY, str(self.service.pk), self.user_identifier])
+
+    def is_throttled(self):
+        if cache.get(self.get_cache_key()):
+            return True
+        return self.is_throttled_in_database()
+
+    def is_throttled_in_database(self):
+        from datetime import datetime, timedelta
+        from multitreehole.routers import primary_only
+        threshold = datetime.now() - timedelta(seconds=self.throttle)
+        with primary_only():
+            return Message.filter_service(self.service).filter(
+                user_identifier=self.user_identifier,
+                timestamp__gt=threshold,
+            ).exists()
+
+    def __call__(self):
+        self.reserved = cache.add(self.get_cache_key(), True, self.throttle)
+        if not self.reserved and cache.get(self.get_cache_key()) is None:
+            # The cache is unreachable (or the slot just expired); fall
+            # back to the database like before reservations existed.
+            logging.warning('Throttle reservation failed without a reservation in the cache.')
+            return not self.is_throttled_in_database()
+        return self.reserved
+
+    def release(self):
+        if self.reserved:
+            cache.delete(self.get_cache_key())
+            self.reserved = False
+
 class Message(models.Model):
-    service = models.ForeignKey(Service, db_index=True)
+    # No constraints or cascades: messages may be sharded away from services
+    # and backends. Service.delete() deletes messages itself.
+    service = models.ForeignKey(Service, db_index=True, db_constraint=False,
+        on_delete=models.DO_NOTHING)
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     user_identifier = models.CharField(max_length=255, db_index=True)
     text = models.TextField()
@@ -181,8 +243,11 @@ class Message(models.Model):
     # "approved" means whether this message is approved or not in manual review.
     # A "closed", "approved" message without backend set is an error.
     approved = models.NullBooleanField(db_index=True)
-    backend = models.ForeignKey(Backend, null=True)
+    backend = models.ForeignKey(Backend, null=True, db_constraint=False,
+        on_delete=models.DO_NOTHING)
     backend_data = models.TextField()
+    # Set on every save; drives the change feed (see multitreehole.changes).
+    changed = models.DateTimeField(null=True, db_index=True)
     if use_ancestor:
         key = DbKeyField(primary_key=True, parent_key_name='parent_key')
 
@@ -194,6 +259,22 @@ class Message(models.Model):
             self.parent_key = service.key
         self.service = service
 
+    def save(self, *args, **kwargs):
+        from datetime import datetime
+        self.changed = datetime.now()
+        super(Message, self).save(*args, **kwargs)
+        from multitreehole import feed
+        feed.notify(self)
+
+    @classmethod
+    def get_manager(cls, service):
+        '''
+        Messages may be sharded across databases; see multitreehole.routers.
+        '''
+        from multitreehole.routers import get_message_database
+        database = None if use_ancestor else get_message_database(service)
+        return cls.objects.db_manager(database) if database else cls.objects
+
     @classmethod
     def filter_service(cls, service):
         '''
@@ -202,7 +283,18 @@ class Message(models.Model):
         '''
         if use_ancestor:
             return cls.objects.filter(key=AncestorKey(service.key))
-        return cls.objects.filter(service=service)
+        return cls.get_manager(service).filter(service=service)
+
+    @classmethod
+    def all_services(cls):
+        '''
+        Use this instead of objects.all() for messages of every service.
+        '''
+        from multitreehole.routers import get_message_databases, MergedQuerySet
+        databases = () if use_ancestor else get_message_databases()
+        if not databases:
+            return cls.objects.all()
+        return MergedQuerySet(cls.objects.using(database).all() for database in databases)
 
     @classmethod
     def from_service_id(cls, service, id):
@@ -213,7 +305,24 @@ class Message(models.Model):
             return cls.objects.get(key=Key.from_path(
                 cls._meta.db_table, long(id), parent=service.key
             ))
-        return cls.objects.get(service=service, pk=id)
+        return cls.get_manager(service).get(service=service, pk=id)
+
+    @classmethod
+    def attach_related(cls, messages):
+        '''
+        Loads service and backend of all messages with one query each,
+        instead of one per message when templates touch them. Works
+        without joins, so also on the datastore and across shards.
+        '''
+        messages = list(messages)
+        for field_name, model in (('service', Service), ('backend', Backend)):
+            field = cls._meta.get_field(field_name)
+            ids = set(getattr(message, field.attname) for message in messages)
+            ids.discard(None)
+            objects = model.objects.in_bulk(list(ids)) if ids else {}
+            for message in messages:
+                setattr(message, field.get_cache_name(), objects.get(getattr(message, field.attname)))
+        return messages
 
     def get_id(self):
         '''
@@ -222,3 +331,41 @@ class Message(models.Model):
         if use_ancestor:
             return self.key.id()
         return self.pk
+
+class ActivityCounter(models.Model):
+    '''
+    One shard of an hourly activity bucket, maintained by multitreehole.rollups.
+
+    Rows with per_identifier unset are per-service totals. Duplicate rows for
+    the same bucket and shard are harmless since readers sum them.
+
+    Per-identifier rows are unsharded (shard 0) and only kept until their
+    hour is summarized into ActivityTop.
+    '''
+    service = models.ForeignKey(Service, db_index=True)
+    per_identifier = models.BooleanField(db_index=True)
+    user_identifier = models.CharField(max_length=255, db_index=True)
+    kind = models.CharField(max_length=16, db_index=True)
+    hour = models.DateTimeField(db_index=True)
+    shard = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+class ActivityTop(models.Model):
+    '''
+    The busiest user identifiers of a service for one kind and completed
+    hour, written once by multitreehole.rollups.summarize(). entries is a
+    JSON list of [user_identifier, count], busiest first and bounded in
+    length.
+    '''
+    service = models.ForeignKey(Service, db_index=True)
+    kind = models.CharField(max_length=16, db_index=True)
+    hour = models.DateTimeField(db_index=True)
+    entries = models.TextField(default='[]')
+
+class BlockedIdentifier(models.Model):
+    '''
+    A blocklist entry of a service, checked by multitreehole.blocklist.
+    value is a user identifier, an address or a network like 10.1.0.0/16.
+    '''
+    service = models.ForeignKey(Service, db_index=True)
+    value = models.CharField(max_length=255, db_index=True)
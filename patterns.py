@@ -0,0 +1,179 @@
+'''
+Safe matching of owner-supplied "reject" and "moderate" patterns.
+
+Patterns are checked when a service is saved, refusing constructs that
+make a backtracking engine take exponential time: nested variable
+repetition and overlapping alternatives under any repetition. Matching
+uses re2, a linear-time engine, when it is installed. Otherwise it uses
+re with a cap on text length (MULTITREEHOLE_PATTERN_MAX_TEXT, 1000 by
+default), and the widths of all variable repetitions multiply the worst
+case, an unbounded one like .* counting as the cap. Their product may be
+at most twice the cap: one unbounded repetition with an optional
+character, or \w{0,40}\w{0,40}, but not .*a.*x or \w{0,99}\w{0,99}, so
+a search stays within milliseconds. Either way, every check_access call
+gets a time budget, and patterns that fail the check, overrun the budget
+or meet an over-long text send the message to moderation instead.
+'''
+
+from django.conf import settings
+
+import re
+import sre_constants
+import sre_parse
+import threading
+import time
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+MAX_PATTERN_LENGTH = 1000
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+class UnsafePattern(ValueError):
+    pass
+
+def get_children(op, av):
+    '''
+    Subpatterns of a parsed regular expression item.
+    '''
+    if op in REPEATS:
+        return [av[2]]
+    if op == sre_constants.SUBPATTERN:
+        return [av[-1]]
+    if op == sre_constants.BRANCH:
+        return av[1]
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [child for child in av[1:] if child is not None]
+    return []
+
+def is_ambiguous_branch(alternatives):
+    '''
+    Whether two alternatives may match the same start. Only alternatives
+    starting with distinct literals are trusted.
+    '''
+    firsts = set()
+    for alternative in alternatives:
+        alternative = list(alternative)
+        if not alternative or alternative[0][0] != sre_constants.LITERAL:
+            return True
+        if alternative[0][1] in firsts:
+            return True
+        firsts.add(alternative[0][1])
+    return False
+
+def has_ambiguous_branch(items):
+    for op, av in items:
+        if op == sre_constants.BRANCH and is_ambiguous_branch(av[1]):
+            return True
+        for child in get_children(op, av):
+            if has_ambiguous_branch(child):
+                return True
+    return False
+
+def check_items(items, repeated=False):
+    '''
+    repeated is set inside a repetition that may match more than once.
+    '''
+    for op, av in items:
+        if op == sre_constants.GROUPREF or op == sre_constants.GROUPREF_EXISTS:
+            raise UnsafePattern('Backreferences are not allowed.')
+        if op in REPEATS:
+            if repeated and av[0] != av[1]:
+                raise UnsafePattern('Nested repetition like (a+)+ is not allowed.')
+            if av[1] > 1 and has_ambiguous_branch(av[2]):
+                raise UnsafePattern('Repeated alternatives that can match the same text, like (a|ab)*, are not allowed.')
+        for child in get_children(op, av):
+            check_items(child, repeated or (op in REPEATS and av[1] > 1))
+
+def get_cost(items, max_text):
+    '''
+    Roughly how many ways a backtracking engine may try to split one
+    match attempt: the product of the widths of variable repetitions,
+    an unbounded one counting as max_text, over ambiguous alternatives
+    summed.
+    '''
+    cost = 1
+    for op, av in items:
+        children = get_children(op, av)
+        if op == sre_constants.BRANCH:
+            costs = [get_cost(child, max_text) for child in children]
+            cost *= sum(costs) if is_ambiguous_branch(av[1]) else max(costs)
+        else:
+            for child in children:
+                cost *= get_cost(child, max_text)
+            if op in REPEATS and av[1] > av[0]:
+                cost *= min(av[1], max_text) - av[0] + 1
+    return cost
+
+def get_max_text():
+    return getattr(settings, 'MULTITREEHOLE_PATTERN_MAX_TEXT', 1000)
+
+def check_pattern(pattern):
+    '''
+    Raises UnsafePattern (a ValueError) if the pattern is invalid or may
+    backtrack catastrophically.
+    '''
+    if not isinstance(pattern, basestring):
+        raise UnsafePattern('Pattern must be a string.')
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise UnsafePattern('Pattern is longer than %d characters.' % MAX_PATTERN_LENGTH)
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError, RuntimeError), e:
+        raise UnsafePattern('Invalid pattern: %s' % e)
+    check_items(parsed)
+    max_text = get_max_text()
+    if re2 is None and get_cost(parsed, max_text) > 2 * (max_text + 1):
+        raise UnsafePattern('Too many variable repetitions like .*, \\w+ or {0,99} '
+            'for matching without re2 installed.')
+
+def compile_pattern(pattern):
+    '''
+    Returns a compiled pattern, or None if it is unsafe. Results are cached.
+    '''
+    with _compiled_lock:
+        if pattern in _compiled:
+            return _compiled[pattern]
+    try:
+        check_pattern(pattern)
+    except UnsafePattern:
+        compiled = None
+    else:
+        compiled = (re2 or re).compile(pattern)
+    with _compiled_lock:
+        _compiled[pattern] = compiled
+    return compiled
+
+class Budget(object):
+    '''
+    Time allowed for all pattern matching of one check_access call.
+    '''
+    def __init__(self, seconds=None):
+        if seconds is None:
+            seconds = getattr(settings, 'MULTITREEHOLE_PATTERN_BUDGET', 0.05)
+        self.deadline = time.time() + seconds
+
+    def exceeded(self):
+        return time.time() > self.deadline
+
+def search(pattern, text, budget):
+    '''
+    Returns True or False, or None if the pattern can't be run safely
+    on this text within the budget.
+    '''
+    if budget.exceeded():
+        return None
+    if re2 is None and len(text) > get_max_text():
+        return None
+    compiled = compile_pattern(pattern)
+    if compiled is None:
+        return None
+    return bool(compiled.search(text))
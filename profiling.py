@@ -0,0 +1,132 @@
+'''
+On-demand profiling of single requests.
+
+Owners get a signed token from the config page, bound to the owner it
+was issued to. A request by that owner, while still an owner, carrying it
+in the "_profile" query parameter or the X-Multitreehole-Profile header
+runs under cProfile with SQL timings recorded, and the trace goes into a
+small per-service ring buffer in the cache. Requests without a token
+only pay for the lookup of the parameter and the header.
+'''
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import connections
+
+from functools import wraps
+import cProfile
+import logging
+import pstats
+import StringIO
+import time
+import traceback
+
+QUERY_PARAMETER = '_profile'
+HEADER = 'HTTP_X_MULTITREEHOLE_PROFILE'
+SIGNING_SALT = 'multitreehole.profiling'
+COUNTER_CACHE_KEY = 'multitreehole_profile_counter'
+TRACE_CACHE_KEY = 'multitreehole_profile_trace'
+
+def get_buffer_size():
+    return getattr(settings, 'MULTITREEHOLE_PROFILE_BUFFER_SIZE', 20)
+
+def make_token(service, user):
+    return signing.dumps([service.slug, user.pk], salt=SIGNING_SALT)
+
+def check_token(request, token):
+    '''
+    Whether the token was issued for this service to the requesting user,
+    who must still be one of its owners.
+    '''
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return False
+    try:
+        slug, user_pk = signing.loads(token, salt=SIGNING_SALT,
+            max_age=getattr(settings, 'MULTITREEHOLE_PROFILE_TOKEN_MAX_AGE', 24 * 3600))
+    except (signing.BadSignature, TypeError, ValueError):
+        return False
+    if slug != request.service.slug or user_pk != user.pk:
+        return False
+    return request.service.is_owner(user)
+
+def get_counter_key(service):
+    return ':'.join([COUNTER_CACHE_KEY, str(service.pk)])
+
+def get_trace_key(service, slot):
+    return ':'.join([TRACE_CACHE_KEY, str(service.pk), str(slot)])
+
+def store_trace(service, trace):
+    key = get_counter_key(service)
+    cache.add(key, 0, None)
+    try:
+        number = cache.incr(key)
+    except ValueError:
+        number = 1
+        cache.set(key, number, None)
+    trace['number'] = number
+    cache.set(get_trace_key(service, number % get_buffer_size()), trace,
+        getattr(settings, 'MULTITREEHOLE_PROFILE_TIMEOUT', 7 * 24 * 3600))
+    return number
+
+def get_traces(service):
+    '''
+    Stored traces, newest first.
+    '''
+    size = get_buffer_size()
+    traces = cache.get_many([get_trace_key(service, slot) for slot in xrange(size)]).values()
+    traces.sort(key=lambda trace: -trace['number'])
+    return traces
+
+def profile_request(view, request, args, kwargs):
+    debug_cursors = {}
+    query_counts = {}
+    for connection in connections.all():
+        debug_cursors[connection.alias] = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        query_counts[connection.alias] = len(connection.queries)
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        response = profiler.runcall(view, request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response = profiler.runcall(response.render)
+    finally:
+        duration = time.time() - start
+        queries = []
+        for connection in connections.all():
+            for query in connection.queries[query_counts.get(connection.alias, 0):]:
+                queries.append((connection.alias, query['sql'], float(query['time'])))
+            connection.use_debug_cursor = debug_cursors.get(connection.alias)
+    stream = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(getattr(settings, 'MULTITREEHOLE_PROFILE_LINES', 50))
+    try:
+        number = store_trace(request.service, {
+            'timestamp': start,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'duration': duration,
+            'queries': queries,
+            'query_time': sum(query[2] for query in queries),
+            'profile': stream.getvalue(),
+        })
+    except Exception:
+        logging.warning('Profile trace storing failure: ' + traceback.format_exc())
+    else:
+        response['X-Multitreehole-Profile'] = str(number)
+    return response
+
+def profiled(view):
+    '''
+    Profiles the view when the request carries a valid token.
+    request.service must already be set.
+    '''
+    @wraps(view)
+    def func(request, *args, **kwargs):
+        token = request.GET.get(QUERY_PARAMETER) or request.META.get(HEADER)
+        if token and check_token(request, token):
+            return profile_request(view, request, args, kwargs)
+        return view(request, *args, **kwargs)
+    return func
@@ -0,0 +1,57 @@
+from multitreehole.models import Message
+
+import logging
+import time
+
+def get_run_in_transaction():
+    try:
+        from google.appengine.ext import db
+        from multitreehole.models import use_ancestor
+    except ImportError:
+        use_transaction = False
+    else:
+        use_transaction = use_ancestor
+
+    if use_transaction:
+        # Each batch comes from one entity group, so it fits in one transaction.
+        return db.run_in_transaction
+    return lambda func, *args, **kwargs: func(*args, **kwargs)
+
+def purge_service(service, batch_size=100, pause=0.5, max_batches=None):
+    '''
+    Deletes closed messages past the service's retention period,
+    oldest first, in batches of batch_size along the timestamp index.
+
+    Sleeps pause seconds between batches so live traffic is not starved.
+    Deleted rows are gone, so an interrupted run simply resumes with the
+    oldest messages left; messages still open are skipped until they
+    close. Returns the number of messages deleted.
+    '''
+    threshold = service.get_retention_threshold()
+    if threshold is None:
+        return 0
+    run_in_transaction = get_run_in_transaction()
+    deleted = 0
+    batches = 0
+
+    def delete_batch(pks):
+        Message.filter_service(service).filter(pk__in=pks).delete()
+
+    while max_batches is None or batches < max_batches:
+        queryset = Message.filter_service(service).filter(
+            closed=True,
+            timestamp__lt=threshold,
+        )
+        batch = list(queryset.order_by('timestamp')[:batch_size])
+        if not batch:
+            break
+        run_in_transaction(delete_batch, [message.pk for message in batch])
+        deleted += len(batch)
+        batches += 1
+        logging.info('Purged %d messages from service %s up to %s' % (
+            len(batch), service.slug, batch[-1].timestamp))
+        if len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted
@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.db.models import F
+
+from multitreehole.models import ActivityCounter, ActivityTop
+
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+import traceback
+
+# Kinds of activity counted per hour.
+SUBMITTED = 'submitted'
+MODERATED = 'moderated'
+PUBLISHED = 'published'
+REJECTED = 'rejected'
+THROTTLED = 'throttled'
+APPROVED = 'approved'
+DISAPPROVED = 'disapproved'
+# Not hourly: a running total of messages waiting for moderation.
+PENDING = 'pending'
+PENDING_HOUR = datetime(1970, 1, 1)
+# Kinds also counted per user identifier, for get_top_identifiers().
+IDENTIFIER_KINDS = (SUBMITTED,)
+
+def get_shard_count():
+    return getattr(settings, 'MULTITREEHOLE_ACTIVITY_SHARDS', 8)
+
+def get_top_size():
+    return getattr(settings, 'MULTITREEHOLE_ACTIVITY_TOP_SIZE', 50)
+
+def truncate_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def increment(service, kind, hour, user_identifier=None, delta=1):
+    filters = {
+        'service': service,
+        'per_identifier': bool(user_identifier),
+        'user_identifier': user_identifier or '',
+        'kind': kind,
+        'hour': hour,
+        # Each identifier is rarely busy, so its rows need no sharding.
+        'shard': random.randrange(get_shard_count()) if not user_identifier else 0,
+    }
+    if not ActivityCounter.objects.filter(**filters).update(count=F('count') + delta):
+        ActivityCounter.objects.create(count=delta, **filters)
+
+def record(service, kind, user_identifier=None, delta=1):
+    '''
+    Counts one event for the service and, if given, the user identifier.
+    Never raises: losing a count is better than failing the request.
+    '''
+    try:
+        if kind == PENDING:
+            increment(service, kind, PENDING_HOUR, delta=delta)
+            return
+        hour = truncate_hour(datetime.now())
+        increment(service, kind, hour, delta=delta)
+        if user_identifier and kind in IDENTIFIER_KINDS:
+            increment(service, kind, hour, user_identifier, delta)
+    except Exception:
+        logging.warning('Activity counter update failure: ' + traceback.format_exc())
+
+def get_hourly_totals(service=None, hours=24):
+    '''
+    Returns {(service_id, user_identifier, kind): count} over the last hours.
+    user_identifier is always '' since only per-service totals are hourly.
+    '''
+    since = truncate_hour(datetime.now() - timedelta(hours=hours - 1))
+    queryset = ActivityCounter.objects.filter(per_identifier=False, hour__gte=since)
+    if service is not None:
+        queryset = queryset.filter(service=service)
+    totals = {}
+    for counter in queryset:
+        if counter.kind == PENDING:
+            continue
+        key = (counter.service_id, counter.user_identifier, counter.kind)
+        totals[key] = totals.get(key, 0) + counter.count
+    return totals
+
+def summarize(now=None):
+    '''
+    Folds the per-identifier counters of completed hours into ActivityTop
+    rows, keeping the get_top_size() busiest identifiers of each service,
+    kind and hour, and deletes the counters. Meant to run periodically
+    (see multitreehole_summarize_activity). Returns the number of hours
+    summarized.
+    '''
+    current = truncate_hour(now or datetime.now())
+    hours = set(ActivityCounter.objects.filter(
+        per_identifier=True, hour__lt=current).values_list('hour', flat=True))
+    size = get_top_size()
+    for hour in sorted(hours):
+        counters = list(ActivityCounter.objects.filter(per_identifier=True, hour=hour))
+        totals = {}
+        for counter in counters:
+            entries = totals.setdefault((counter.service_id, counter.kind), {})
+            entries[counter.user_identifier] = \
+                    entries.get(counter.user_identifier, 0) + counter.count
+        for (service_id, kind), entries in totals.iteritems():
+            top = sorted(entries.iteritems(), key=lambda entry: -entry[1])[:size]
+            ActivityTop.objects.create(service_id=service_id, kind=kind, hour=hour,
+                entries=json.dumps(top))
+        # Counters written after the read stay for the next run; readers
+        # add up every ActivityTop row of an hour.
+        ActivityCounter.objects.filter(pk__in=[counter.pk for counter in counters]).delete()
+    return len(hours)
+
+def get_top_identifiers(service=None, hours=24, kind=SUBMITTED, limit=20):
+    '''
+    Returns [(service_id, user_identifier, count)], busiest first, over
+    the last hours.
+
+    Summarized hours only remember their busiest identifiers, so counts
+    are approximate: an identifier is left out of an hour in which it
+    did not rank. Only IDENTIFIER_KINDS are counted.
+    '''
+    since = truncate_hour(datetime.now() - timedelta(hours=hours - 1))
+    tops = ActivityTop.objects.filter(kind=kind, hour__gte=since)
+    counters = ActivityCounter.objects.filter(per_identifier=True, kind=kind, hour__gte=since)
+    if service is not None:
+        tops = tops.filter(service=service)
+        counters = counters.filter(service=service)
+    totals = {}
+    for top in tops:
+        for user_identifier, count in json.loads(top.entries):
+            key = (top.service_id, user_identifier)
+            totals[key] = totals.get(key, 0) + count
+    # Hours not summarized yet.
+    for counter in counters:
+        key = (counter.service_id, counter.user_identifier)
+        totals[key] = totals.get(key, 0) + counter.count
+    top = [(service_id, user_identifier, count)
+        for (service_id, user_identifier), count in totals.iteritems()]
+    top.sort(key=lambda item: -item[2])
+    return top[:limit]
+
+def get_pending_counts(service=None):
+    '''
+    Returns {service_id: number of messages waiting for moderation}.
+    '''
+    queryset = ActivityCounter.objects.filter(kind=PENDING, hour=PENDING_HOUR)
+    if service is not None:
+        queryset = queryset.filter(service=service)
+    counts = {}
+    for counter in queryset:
+        counts[counter.service_id] = counts.get(counter.service_id, 0) + counter.count
+    return counts
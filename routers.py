@@ -0,0 +1,328 @@
+'''
+Database routing for the SQL deployment.
+
+Add 'multitreehole.routers.MessageShardRouter' to DATABASE_ROUTERS and list
+the database aliases for messages in MULTITREEHOLE_MESSAGE_DATABASES. Each
+service's messages live on the alias stored in Service.message_database,
+picked by a hash of its slug the first time it is needed; everything else
+stays on the default database.
+
+Since the alias is stored, adding aliases moves no existing service. Run
+multitreehole_move_messages without arguments before changing the list,
+so that services never used yet keep the alias they hash to now, and
+with a slug and an alias to move a service's messages.
+
+Add 'multitreehole.routers.ReplicaRouter' after it, list replicas of the
+default database in MULTITREEHOLE_READ_REPLICAS and install
+ReplicaPinMiddleware to let views wrapped in read_from_replicas read from
+them. Neither is used on App Engine.
+'''
+
+from django.conf import settings
+
+from functools import wraps
+import heapq
+import itertools
+import random
+import threading
+import time
+import zlib
+
+PIN_COOKIE_NAME = 'multitreehole_primary_until'
+
+_state = threading.local()
+
+def mark_write():
+    _state.wrote = True
+
+def get_message_databases():
+    return tuple(getattr(settings, 'MULTITREEHOLE_MESSAGE_DATABASES', ()))
+
+def get_message_database(service):
+    '''
+    Returns the alias holding messages of the service, or None if
+    messages are not sharded. Assigns one if the service has none yet.
+    '''
+    aliases = get_message_databases()
+    if not aliases:
+        return None
+    if not service.message_database:
+        assign_message_database(service)
+    return service.message_database
+
+def assign_message_database(service):
+    from multitreehole.models import Service
+    aliases = get_message_databases()
+    service.message_database = \
+            aliases[(zlib.crc32(service.slug.encode('utf-8')) & 0xffffffff) % len(aliases)]
+    if service.pk is not None:
+        # Only if still unassigned, so a concurrent move is not undone.
+        if not Service.objects.using('default').filter(pk=service.pk, message_database='').update(
+                message_database=service.message_database):
+            service.message_database = Service.objects.using('default').values_list(
+                'message_database', flat=True).get(pk=service.pk)
+
+def is_message_model(model):
+    # issubclass also covers the classes Django makes for deferred fields.
+    from multitreehole.models import Message
+    return issubclass(model, Message)
+
+class MessageShardRouter(object):
+    '''
+    Queries on a single service should go through Message.filter_service()
+    and Message.from_service_id(), which pick the alias explicitly; the
+    router covers saves and related lookups, which pass the instance.
+
+    Every other model lives on the default database (or its replicas), even
+    when reached from a message loaded from a shard.
+    '''
+    def get_instance_database(self, model, hints):
+        instance = hints.get('instance')
+        if instance is None or not is_message_model(type(instance)):
+            return None
+        # Not instance.service, which would be looked up on the message's
+        # own shard unless already cached.
+        service = getattr(instance, instance._meta.get_field('service').get_cache_name(), None)
+        if service is not None:
+            return get_message_database(service)
+        return get_service_database(instance.service_id)
+
+    def db_for_read(self, model, **hints):
+        if not get_message_databases():
+            return None
+        if is_message_model(model):
+            return self.get_instance_database(model, hints)
+        return pick_read_replica() or 'default'
+
+    def db_for_write(self, model, **hints):
+        mark_write()
+        if not get_message_databases():
+            return None
+        if is_message_model(model):
+            return self.get_instance_database(model, hints)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_message_model(type(obj1)) or is_message_model(type(obj2)):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        aliases = get_message_databases()
+        if not aliases:
+            return None
+        if is_message_model(model):
+            return db in aliases
+        if db in aliases and db != 'default':
+            return False
+        return None
+
+SERVICE_DATABASE_SECONDS = 60
+
+_service_databases = {}
+
+def get_service_database(service_id):
+    '''
+    The message alias of a service, read from the default database and
+    kept for SERVICE_DATABASE_SECONDS, so a moved service is picked up
+    within that time.
+    '''
+    now = time.time()
+    checked, database = _service_databases.get(service_id, (0, None))
+    if now - checked > SERVICE_DATABASE_SECONDS:
+        from multitreehole.models import Service
+        database = get_message_database(Service.objects.using('default').get(pk=service_id))
+        _service_databases[service_id] = (now, database)
+    return database
+
+def get_read_replicas():
+    return tuple(getattr(settings, 'MULTITREEHOLE_READ_REPLICAS', ()))
+
+def pick_read_replica():
+    '''
+    A random replica inside read_from_replicas, unless the client wrote
+    recently or the code runs under primary_only(); otherwise None.
+    '''
+    replicas = get_read_replicas()
+    if replicas and getattr(_state, 'replicas', False) and not getattr(_state, 'primary', 0):
+        return random.choice(replicas)
+    return None
+
+class ReplicaRouter(object):
+    '''
+    Sends reads to a random replica inside read_from_replicas, unless the
+    client wrote recently or the code runs under primary_only().
+    '''
+    def db_for_read(self, model, **hints):
+        return pick_read_replica()
+
+    def db_for_write(self, model, **hints):
+        mark_write()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = ('default',) + get_read_replicas()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in get_read_replicas():
+            return False
+        return None
+
+def is_pinned(request):
+    '''
+    Whether this client wrote within the last MULTITREEHOLE_REPLICA_PIN_SECONDS.
+    '''
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE_NAME)) > time.time()
+    except (TypeError, ValueError):
+        return False
+
+def read_from_replicas(view):
+    '''
+    Lets reads in a read-only view go to replicas.
+    '''
+    @wraps(view)
+    def func(request, *args, **kwargs):
+        if is_pinned(request):
+            return view(request, *args, **kwargs)
+        previous = getattr(_state, 'replicas', False)
+        _state.replicas = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _state.replicas = previous
+    return func
+
+class primary_only(object):
+    '''
+    Context manager for reads that need strong consistency.
+    '''
+    def __enter__(self):
+        _state.primary = getattr(_state, 'primary', 0) + 1
+
+    def __exit__(self, *exc_info):
+        _state.primary -= 1
+
+class ReplicaPinMiddleware(object):
+    '''
+    Keeps a client on the primary for a while after any request of theirs
+    writes, so they read their own writes.
+    '''
+    def process_request(self, request):
+        _state.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_state, 'wrote', False):
+            seconds = getattr(settings, 'MULTITREEHOLE_REPLICA_PIN_SECONDS', 10)
+            response.set_cookie(PIN_COOKIE_NAME, str(time.time() + seconds), max_age=seconds)
+            _state.wrote = False
+        return response
+
+class OrderKey(object):
+    '''
+    Sort key for one object under a Django ordering like ['-timestamp', 'pk'].
+    '''
+    def __init__(self, obj, ordering):
+        self.values = []
+        for field in ordering:
+            descending = field.startswith('-')
+            self.values.append((getattr(obj, field.lstrip('-')), descending))
+
+    def __lt__(self, other):
+        for (value, descending), (other_value, _) in zip(self.values, other.values):
+            if value != other_value:
+                return (other_value < value) if descending else (value < other_value)
+        return False
+
+def merge_sorted(iterables, ordering):
+    '''
+    k-way merge of iterables that are each sorted by ordering.
+    '''
+    heap = []
+    iterators = [iter(iterable) for iterable in iterables]
+    for index, iterator in enumerate(iterators):
+        for obj in iterator:
+            heap.append((OrderKey(obj, ordering), index, obj))
+            break
+    heapq.heapify(heap)
+    while heap:
+        key, index, obj = heap[0]
+        yield obj
+        for obj in iterators[index]:
+            heapq.heapreplace(heap, (OrderKey(obj, ordering), index, obj))
+            break
+        else:
+            heapq.heappop(heap)
+
+class MergedQuerySet(object):
+    '''
+    The same query run on several databases and merged in order.
+
+    Filtering and ordering calls are applied to every database; slicing
+    fetches at most "stop" rows from each and merges them, so pages near
+    the start stay cheap. Ordering by fields other than those on the
+    model itself is not supported.
+    '''
+    DEFAULT_ORDERING = ('-timestamp', '-pk')
+
+    def __init__(self, querysets):
+        self.querysets = list(querysets)
+        self.model = self.querysets[0].model if self.querysets else None
+
+    def _map(name):
+        def method(self, *args, **kwargs):
+            return MergedQuerySet([getattr(queryset, name)(*args, **kwargs) for queryset in self.querysets])
+        method.__name__ = name
+        return method
+
+    all = _map('all')
+    filter = _map('filter')
+    exclude = _map('exclude')
+    order_by = _map('order_by')
+    distinct = _map('distinct')
+    select_related = _map('select_related')
+    defer = _map('defer')
+    only = _map('only')
+    none = _map('none')
+    del _map
+
+    def get_ordering(self):
+        if self.querysets:
+            ordering = list(self.querysets[0].query.order_by or self.model._meta.ordering)
+            if ordering:
+                return ['pk' if field == 'id' else '-pk' if field == '-id' else field for field in ordering]
+        return list(self.DEFAULT_ORDERING)
+
+    def get_ordered_querysets(self):
+        ordering = self.get_ordering()
+        return ordering, [queryset.order_by(*ordering) for queryset in self.querysets]
+
+    def count(self):
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def exists(self):
+        return any(queryset.exists() for queryset in self.querysets)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        ordering, querysets = self.get_ordered_querysets()
+        return merge_sorted(querysets, ordering)
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            results = self[k:k + 1]
+            if not results:
+                raise IndexError(k)
+            return results[0]
+        if k.stop is None or k.step:
+            return list(itertools.islice(iter(self), k.start, k.stop, k.step))
+        ordering, querysets = self.get_ordered_querysets()
+        return list(itertools.islice(
+            merge_sorted([queryset[:k.stop] for queryset in querysets], ordering),
+            k.start or 0, k.stop,
+        ))
@@ -0,0 +1,142 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from multitreehole import patterns
+from multitreehole.backends import contract
+from multitreehole.models import Backend, Service, Message
+from multitreehole.views import MessageListView
+
+import json
+import os
+import tempfile
+
+class MessageListQueriesTestCase(TestCase):
+    '''
+    The message list must cost the same number of queries whatever the
+    page size, on a service and on the meta site. The response is not
+    rendered; instead the related objects templates use must already be
+    loaded.
+    '''
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser('owner', 'owner@example.com', 'owner')
+        self.meta = Service(slug='meta', backend=None, params='{}')
+        self.meta.label = self.meta.slug
+        self.meta.save()
+        self.services = []
+        for i in range(2):
+            backend = Backend(
+                path='multitreehole.backends.localfile.LocalFileBackend',
+                params=json.dumps({'file-name': '/dev/null'}),
+            )
+            backend.save()
+            service = Service(slug='service%d' % i, backend=backend, params='{}')
+            service.label = service.slug
+            service.owners.add(self.user.pk)
+            service.save()
+            self.services.append(service)
+            for j in range(30):
+                message = Message()
+                message.set_service(service)
+                message.user_identifier = '10.0.0.%d' % j
+                message.text = 'Message %d' % j
+                # Published, so every page needs its backend loaded.
+                message.closed = True
+                message.backend = backend
+                message.backend_data = '{}'
+                message.save()
+
+    def get_page(self, slug, page_size):
+        request = RequestFactory().get('/', {'page_size': page_size},
+            HTTP_HOST=slug + '.example.com')
+        request.user = self.user
+        response = MessageListView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def count_queries(self, slug, page_size):
+        with CaptureQueriesContext(connection) as context:
+            self.get_page(slug, page_size)
+        return len(context)
+
+    def touch_related(self, messages):
+        for message in messages:
+            self.assertTrue(message.service.slug)
+            self.assertTrue(message.backend.path)
+
+    def check_page_sizes(self, slug):
+        expected = self.count_queries(slug, 2)
+        self.assertNumQueries(expected, self.get_page, slug, 20)
+        response = self.get_page(slug, 20)
+        messages = response.context_data['message_list'].object_list
+        self.assertEqual(len(messages), 20)
+        self.assertNumQueries(0, self.touch_related, messages)
+
+    def test_service_page(self):
+        self.check_page_sizes('service0')
+
+    def test_meta_page(self):
+        self.check_page_sizes('meta')
+
+class PatternCheckTestCase(SimpleTestCase):
+    '''
+    Owner patterns that could stall a publish with re must be refused.
+    '''
+    UNSAFE = [
+        r'(a+){50}b',
+        r'(\w+\s?){2,99}!',
+        r'(a|ab)*c',
+        r'.*.*.*.*.*.*x',
+        r'.*a.*x',
+        r'\w+\s?\w+!',
+        r'[a-z]{0,99}[a-z]{0,99}[a-z]{0,99}[a-z]{0,99}x',
+        r'\w{0,99}\w{0,99}\w{0,99}!',
+        r'(a)\1',
+    ]
+    SAFE = [
+        r'spam|\d{4}',
+        r'ab+c',
+        r'(foo|bar)+',
+        r'https?://\S+',
+        r'colou?r',
+        r'^\d{3}-\d{4}$',
+    ]
+
+    def setUp(self):
+        self.re2 = patterns.re2
+        # The limits on variable repetitions only apply without re2.
+        patterns.re2 = None
+
+    def tearDown(self):
+        patterns.re2 = self.re2
+
+    def test_unsafe(self):
+        with self.settings(MULTITREEHOLE_PATTERN_MAX_TEXT=1000):
+            for pattern in self.UNSAFE:
+                self.assertRaises(patterns.UnsafePattern, patterns.check_pattern, pattern)
+
+    def test_safe(self):
+        with self.settings(MULTITREEHOLE_PATTERN_MAX_TEXT=1000):
+            for pattern in self.SAFE:
+                patterns.check_pattern(pattern)
+
+    def test_search_moderates_unsafe(self):
+        budget = patterns.Budget(1)
+        self.assertEqual(patterns.search(r'(a+){50}b', 'a' * 26, budget), None)
+        self.assertEqual(patterns.search(r'ab+c', 'xabbc', budget), True)
+
+# The backend contract, run against the stand-in for every forced outcome
+# and against the local file backend. Module level, so the runner finds them.
+for i, config in enumerate(contract.MEMORY_CONFIGS):
+    name = 'MemoryContract%dTestCase' % i
+    globals()[name] = contract.make_test_case(contract.MEMORY_BACKEND_PATH,
+        json.dumps(config), backend_pk=-1 - i, name=name)
+
+LocalFileContractTestCase = contract.make_test_case(
+    'multitreehole.backends.localfile.LocalFileBackend',
+    json.dumps({'file-name': os.path.join(tempfile.gettempdir(), 'multitreehole-contract.txt')}),
+    name='LocalFileContractTestCase')
@@ -3,8 +3,18 @@ from django.core.exceptions import ImproperlyConfigured
 from django.http import Http404
 from django.utils.importlib import import_module
 
+# Backends are stateless, so one instance per path is shared by all requests.
+_backends = {}
+# Backend.pk -> (params, client)
+_clients = {}
+_slug_index = None
+
 # from django.contrib.auth
 def load_backend(path):
+    try:
+        return _backends[path]
+    except KeyError:
+        pass
     i = path.rfind('.')
     module, attr = path[:i], path[i + 1:]
     try:
@@ -17,17 +27,29 @@ def load_backend(path):
         cls = getattr(mod, attr)
     except AttributeError:
         raise ImproperlyConfigured('Module "%s" does not define a "%s" tree hole backend' % (module, attr))
-    return cls()
+    return _backends.setdefault(path, cls())
 
 def get_backends():
-    backends = []
-    for backend_path in getattr(settings, 'MULTITREEHOLE_BACKENDS', ()):
-        backends.append(load_backend(backend_path))
-    return backends
+    return [load_backend(backend_path)
+        for backend_path in getattr(settings, 'MULTITREEHOLE_BACKENDS', ())]
 
 def get_backend_or_404(slug):
-    for backend_path in getattr(settings, 'MULTITREEHOLE_BACKENDS', ()):
-        backend_class = load_backend(backend_path)
-        if backend_class.slug == slug:
-            return backend_class
-    raise Http404
+    global _slug_index
+    if _slug_index is None:
+        _slug_index = dict((backend.slug, backend) for backend in reversed(get_backends()))
+    try:
+        return _slug_index[slug]
+    except KeyError:
+        raise Http404
+
+def get_client(backend):
+    '''
+    Returns a client for a Backend model instance, reused across requests.
+    Clients are rebuilt if the backend params change.
+    '''
+    cached = _clients.get(backend.pk)
+    if cached and cached[0] == backend.params:
+        return cached[1]
+    client = load_backend(backend.path).make_client(backend.pk, backend.params)
+    _clients[backend.pk] = (backend.params, client)
+    return client
@@ -1,10 +1,11 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.decorators import login_required as normal_login_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.forms.util import ErrorList
-from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.utils.decorators import method_decorator
@@ -13,12 +14,17 @@ from django.views.generic import ListView
 from django.views.generic.base import View, TemplateResponseMixin
 
 from multitreehole.filters import MessageFilter
-from multitreehole.forms import ServiceForm, PublishForm
-from multitreehole.models import Backend, Service, Message
-from multitreehole.utils import load_backend, get_backends, get_backend_or_404
+from multitreehole.forms import ServiceForm, PublishForm, BlocklistForm
+from multitreehole.models import Backend, Service, Message, BlockedIdentifier
+from multitreehole.routers import read_from_replicas
+from multitreehole import blocklist, changes, digest, feed, profiling, rollups
+from multitreehole.utils import load_backend, get_backends, get_backend_or_404, get_client
 
+import json
 import logging
+import time
 import traceback
+import uuid
 
 def service_required(view):
     def func(request, *args, **kwargs):
@@ -72,6 +78,7 @@ def get_backend_tuples():
     return backends
 
 @service_required
+@profiling.profiled
 def main(request):
     if request.service.backend:
         request.backend = load_backend(request.service.backend.path)
@@ -162,53 +169,49 @@ class PublishView(View, TemplateResponseMixin):
             'user_identifier': user_identifier,
         })
 
+    TOKEN_CACHE_KEY = 'multitreehole_publish_token'
+
+    def get_token_key(self, request, token):
+        return ':'.join([self.TOKEN_CACHE_KEY, str(request.service.pk), token])
+
     def post(self, request):
         form = self.form_class(request.POST, request.FILES)
         backend_forms = []
         if form.is_valid():
-            text = form.cleaned_data['text']
-            access_level, user_identifier, confirm = request.service.check_access(request, text)
-            def prepare_message():
-                message = Message()
-                message.set_service(request.service)
-                message.user_identifier = user_identifier
-                message.text = text
-                return message
-            if access_level == 'moderate':
-                message = prepare_message()
-                message.closed = False
-                message.save()
-                return render_to_response('multitreehole/publish-moderate.html', {
-                    'user_identifier': user_identifier,
-                    'message': message,
-                }, context_instance=RequestContext(request))
-            elif access_level == 'accept':
-                message = prepare_message()
-                message.closed = True
-                message.save()
-                if confirm(message):
-                    client = request.backend.make_client(
-                        request.service.backend.pk, request.service.backend.params
-                    )
-                    backend_message = client.make_message(form.cleaned_data['text'])
-                    status = backend_message.publish(request.POST, request.FILES)
-                else:
-                    status = {'error': ErrorList([_(
-                        'Access confirmation failed. Are you requesting concurrently?'
-                    )])}
-                if 'forms' in status:
-                    backend_forms = status['forms']
-                if 'error' in status:
-                    form._errors['text'] = status['error']
-                if 'data' in status:
-                    message.backend = request.service.backend
-                    message.backend_data = status['data']
-                    message.save()
-                    return render_to_response('multitreehole/publish-accept.html', {
-                        'user_identifier': user_identifier,
-                        'message': message,
-                    }, context_instance=RequestContext(request))
-                message.delete()
+            token_key = self.get_token_key(request, form.cleaned_data['token'] or uuid.uuid4().hex)
+            reserved = cache.add(token_key, '', getattr(settings, 'MULTITREEHOLE_PUBLISH_TOKEN_TIMEOUT', 3600))
+            if not reserved and cache.get(token_key) is None:
+                # The cache is unreachable (or the token just expired);
+                # publish without retry protection rather than not at all.
+                logging.warning('Publish token reservation failed without a token in the cache.')
+                reserved = True
+            if reserved:
+                try:
+                    response, access_level, user_identifier, backend_forms = \
+                            self.submit(request, form, token_key)
+                except Exception:
+                    # Let the user retry at once unless the message was placed.
+                    if not cache.get(token_key):
+                        cache.delete(token_key)
+                    raise
+                if response:
+                    return response
+                cache.delete(token_key)
+            else:
+                # A retry of a submission that was placed or is in flight.
+                message = None
+                message_id = cache.get(token_key)
+                if message_id:
+                    try:
+                        message = Message.from_service_id(request.service, message_id)
+                    except ObjectDoesNotExist:
+                        pass
+                if message:
+                    return self.render_outcome(request, message)
+                form._errors['text'] = ErrorList([_(
+                    'This message is already being submitted. Please wait.'
+                )])
+                access_level, user_identifier, confirm = request.service.check_access(request)
         else:
             access_level, user_identifier, confirm = request.service.check_access(request)
         return self.render_to_response({
@@ -218,10 +221,90 @@ class PublishView(View, TemplateResponseMixin):
             'user_identifier': user_identifier,
         })
 
+    def submit(self, request, form, token_key):
+        '''
+        Checks access and places the message, writing it once the outcome
+        is known. Returns (response, access_level, user_identifier,
+        backend_forms); response is None if nothing was placed.
+        '''
+        text = form.cleaned_data['text']
+        access_level, user_identifier, confirm = request.service.check_access(request, text)
+        rollups.record(request.service, rollups.SUBMITTED, user_identifier)
+        if access_level == 'reject':
+            rollups.record(request.service, rollups.REJECTED, user_identifier)
+        elif access_level == 'throttle':
+            rollups.record(request.service, rollups.THROTTLED, user_identifier)
+        if access_level not in ('accept', 'moderate'):
+            return None, access_level, user_identifier, []
+        if not confirm():
+            form._errors['text'] = ErrorList([_(
+                'Access confirmation failed. Are you requesting concurrently?'
+            )])
+            return None, access_level, user_identifier, []
+        try:
+            message = Message()
+            message.set_service(request.service)
+            message.user_identifier = user_identifier
+            message.text = text
+            if access_level == 'accept' and digest.get_params(request.service):
+                digest.buffer(message)
+                rollups.record(request.service, rollups.PUBLISHED, user_identifier)
+                response = self.place(request, message, token_key)
+                try:
+                    digest.flush(request.service)
+                except Exception:
+                    # The message is placed; multitreehole_flush_digests retries.
+                    logging.warning('Digest flushing failure: ' + traceback.format_exc())
+                return response, access_level, user_identifier, []
+            if access_level == 'accept':
+                backend_message = get_client(request.service.backend).make_message(text)
+                status = backend_message.publish(request.POST, request.FILES, queue=True)
+                if 'data' in status:
+                    message.closed = True
+                    message.backend = request.service.backend
+                    message.backend_data = status['data']
+                    rollups.record(request.service, rollups.PUBLISHED, user_identifier)
+                    return self.place(request, message, token_key), access_level, user_identifier, []
+                if 'queued' not in status:
+                    confirm.release()
+                    if 'error' in status:
+                        form._errors['text'] = status['error']
+                    return None, access_level, user_identifier, status.get('forms', [])
+                # The backend can't publish right now; hand it to owners.
+            message.closed = False
+            rollups.record(request.service, rollups.MODERATED, user_identifier)
+            rollups.record(request.service, rollups.PENDING)
+            return self.place(request, message, token_key), access_level, user_identifier, []
+        except Exception:
+            # The throttle slot is only kept for a placed message.
+            if not cache.get(token_key):
+                confirm.release()
+            raise
+
+    def place(self, request, message, token_key):
+        message.save()
+        cache.set(token_key, message.get_id(),
+            getattr(settings, 'MULTITREEHOLE_PUBLISH_TOKEN_TIMEOUT', 3600))
+        return self.render_outcome(request, message)
+
+    def render_outcome(self, request, message):
+        if message.closed or message.approved:
+            template_name = 'multitreehole/publish-accept.html'
+        else:
+            template_name = 'multitreehole/publish-moderate.html'
+        return render_to_response(template_name, {
+            'user_identifier': message.user_identifier,
+            'message': message,
+        }, context_instance=RequestContext(request))
+
 class ListServicesView(ListView):
     template_name = 'multitreehole/list_services.html'
     context_object_name = 'services'
 
+    @method_decorator(read_from_replicas)
+    def get(self, request, *args, **kwargs):
+        return super(ListServicesView, self).get(request, *args, **kwargs)
+
     def get_queryset(self):
         return Service.objects.exclude(backend__isnull=True)
 
@@ -272,6 +355,40 @@ class ConfigView(View, TemplateResponseMixin):
             backend = None
         context['backend'] = backend
         context['backends'] = get_backend_tuples()
+        context['profile_token'] = profiling.make_token(self.request.service, self.request.user)
+        context['profile_traces'] = profiling.get_traces(self.request.service)
+        return self.render_to_response(context)
+
+class BlocklistView(View, TemplateResponseMixin):
+    template_name = 'multitreehole/blocklist.html'
+    form_class = BlocklistForm
+
+    @method_decorator(service_required)
+    @method_decorator(normal_service_expected)
+    @method_decorator(login_required)
+    @method_decorator(owner_expected)
+    def dispatch(self, request, *args, **kwargs):
+        return super(BlocklistView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        return self.render_to_response_with_entries({
+            'form': self.form_class(),
+        })
+
+    def post(self, request):
+        form = self.form_class(request.POST, request.FILES)
+        if form.is_valid():
+            added = blocklist.add(request.service, form.cleaned_data['add'].splitlines())
+            blocklist.remove(request.service, form.cleaned_data['remove'].splitlines())
+            return HttpResponseRedirect('?saved=%d' % added)
+        return self.render_to_response_with_entries({
+            'form': form,
+        })
+
+    def render_to_response_with_entries(self, context):
+        entries = BlockedIdentifier.objects.filter(service=self.request.service)
+        context['entry_count'] = entries.count()
+        context['entries'] = entries.order_by('value')[:getattr(settings, 'MULTITREEHOLE_BLOCKLIST_PAGE_SIZE', 200)]
         return self.render_to_response(context)
 
 class ConfigBackendView(View, TemplateResponseMixin):
@@ -311,16 +428,23 @@ class MessageListView(View, TemplateResponseMixin):
     @method_decorator(service_required)
     @method_decorator(login_required)
     @method_decorator(owner_expected)
+    @method_decorator(profiling.profiled)
     def dispatch(self, request, *args, **kwargs):
         return super(MessageListView, self).dispatch(request, *args, **kwargs)
 
+    @method_decorator(read_from_replicas)
     def get(self, request):
         if request.service.backend:
             queryset = Message.filter_service(request.service)
             is_meta = False
         else:
-            queryset = Message.objects.all()
+            queryset = Message.all_services()
             is_meta = True
+        from multitreehole.models import use_ancestor
+        if not use_ancestor:
+            # Only message_details shows backend_data. Datastore entities
+            # are fetched whole anyway.
+            queryset = queryset.defer('backend_data')
         f = MessageFilter(request.GET, queryset=queryset)
         try:
             page_size = int(request.GET.get('page_size'))
@@ -334,6 +458,8 @@ class MessageListView(View, TemplateResponseMixin):
             messages = paginator.page(1)
         except EmptyPage:
             messages = paginator.page(paginator.num_pages)
+        # A fixed number of queries per page, whatever the page size.
+        messages.object_list = Message.attach_related(messages.object_list)
         query = request.GET
         if 'page' in query:
             query = query.copy()
@@ -344,6 +470,7 @@ class MessageListView(View, TemplateResponseMixin):
             'query_string_piece': '?' + query.urlencode() + '&' if query else '?',
             'page_size': page_size,
             'is_meta': is_meta,
+            'feed_cursor': None if is_meta else feed.make_cursor(feed.get_seq(request.service)),
         })
 
     def post(self, request):
@@ -385,6 +512,8 @@ class MessageListView(View, TemplateResponseMixin):
             message_objects[message_id] = message
             if message.closed == closed:
                 return
+            # Buffered digest messages are not counted as pending.
+            message.was_pending = message.approved is None
             message.closed = closed
             message.approved = approved
             message.save()
@@ -417,9 +546,7 @@ class MessageListView(View, TemplateResponseMixin):
                 message_ids_not_approved.add(message_id)
                 continue
             if not client:
-                client = load_backend(request.service.backend.path).make_client(
-                    request.service.backend.pk, request.service.backend.params
-                )
+                client = get_client(request.service.backend)
             backend_message = client.make_message(message.text)
             status = backend_message.publish(request.POST, request.FILES,
                 form_prefix='message_%d' % message_id
@@ -436,6 +563,9 @@ class MessageListView(View, TemplateResponseMixin):
                 message.backend_data = status['data']
                 message.save()
                 message_ids_approved.add(message_id)
+                rollups.record(request.service, rollups.APPROVED, message.user_identifier)
+                if message.was_pending:
+                    rollups.record(request.service, rollups.PENDING, delta=-1)
             else:
                 message_ids_not_approved.add(message_id)
 
@@ -448,6 +578,9 @@ class MessageListView(View, TemplateResponseMixin):
                 continue
             if message:
                 message_ids_rejected.add(message_id)
+                rollups.record(request.service, rollups.DISAPPROVED, message.user_identifier)
+                if message.was_pending:
+                    rollups.record(request.service, rollups.PENDING, delta=-1)
             else:
                 message_ids_not_rejected.add(message_id)
 
@@ -479,6 +612,79 @@ class MessageListView(View, TemplateResponseMixin):
 
 @service_required
 @normal_service_expected
+@login_required
+@owner_expected
+def message_feed(request):
+    '''
+    Pending messages and state changes after a cursor.
+
+    Long-polls and returns JSON, or streams Server-Sent Events if the
+    client asks for text/event-stream (EventSource resumes from
+    Last-Event-ID, which is the cursor).
+    '''
+    cursor = request.GET.get('cursor') or request.META.get('HTTP_LAST_EVENT_ID') \
+            or feed.make_cursor(feed.get_seq(request.service))
+    try:
+        feed.parse_cursor(cursor)
+    except ValueError:
+        return HttpResponseBadRequest()
+    timeout = getattr(settings, 'MULTITREEHOLE_FEED_TIMEOUT', 25)
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        def stream(cursor):
+            deadline = time.time() + timeout
+            yield 'retry: %d\n\n' % (feed.get_interval() * 1000)
+            while time.time() < deadline:
+                events, cursor, resynced = feed.poll(request.service, cursor, deadline - time.time())
+                if events or resynced:
+                    yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+                        cursor, 'resync' if resynced else 'messages', json.dumps(events))
+        return StreamingHttpResponse(stream(cursor), content_type='text/event-stream')
+    events, cursor, resynced = feed.poll(request.service, cursor, timeout)
+    return HttpResponse(json.dumps({
+        'cursor': cursor,
+        'events': events,
+        'resync': resynced,
+    }), content_type='application/json')
+
+@service_required
+@login_required
+@owner_expected
+def change_feed(request):
+    '''
+    JSON batches of messages changed after an opaque cursor. On the meta
+    site this covers every service.
+    '''
+    try:
+        limit = max(1, min(int(request.GET.get('limit')), 1000))
+    except (TypeError, ValueError):
+        limit = 100
+    try:
+        messages, cursor, has_more = changes.get_changes(
+            request.service if request.service.backend else None,
+            request.GET.get('cursor'), limit,
+        )
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest()
+    services = Service.objects.in_bulk(set(message.service_id for message in messages))
+    return HttpResponse(json.dumps({
+        'cursor': cursor,
+        'has_more': has_more,
+        'messages': [{
+            'service': services[message.service_id].slug if message.service_id in services else None,
+            'id': message.get_id(),
+            'timestamp': message.timestamp.isoformat(),
+            'changed': message.changed.isoformat(),
+            'user_identifier': message.user_identifier,
+            'text': message.text,
+            'closed': message.closed,
+            'approved': message.approved,
+            'backend_data': message.backend_data,
+        } for message in messages],
+    }), content_type='application/json')
+
+@service_required
+@normal_service_expected
+@read_from_replicas
 def message_details(request, message_id):
     try:
         message = Message.from_service_id(request.service, message_id)
@@ -489,3 +695,50 @@ def message_details(request, message_id):
         'message': message,
         'is_owner': is_owner,
     }, context_instance=RequestContext(request))
+
+class ActivityView(View, TemplateResponseMixin):
+    template_name = 'multitreehole/activity.html'
+
+    @method_decorator(service_required)
+    @method_decorator(login_required)
+    @method_decorator(owner_expected)
+    def dispatch(self, request, *args, **kwargs):
+        return super(ActivityView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        if request.service.backend:
+            service = request.service
+            services = {service.pk: service}
+        else:
+            # The meta site summarizes every service.
+            service = None
+            services = dict((service_obj.pk, service_obj)
+                for service_obj in Service.objects.exclude(backend__isnull=True))
+        try:
+            hours = max(1, min(int(request.GET.get('hours')), 24 * 7))
+        except (TypeError, ValueError):
+            hours = 24
+        totals = {}
+        for (service_id, user_identifier, kind), count in \
+                rollups.get_hourly_totals(service, hours).iteritems():
+            totals.setdefault(service_id, {})[kind] = count
+        pending = rollups.get_pending_counts(service)
+        service_rows = []
+        for service_id, service_obj in services.iteritems():
+            service_rows.append({
+                'service': service_obj,
+                'totals': totals.get(service_id, {}),
+                'pending': pending.get(service_id, 0),
+            })
+        service_rows.sort(key=lambda row: -row['totals'].get(rollups.SUBMITTED, 0))
+        top_identifiers = [{
+            'service': services.get(service_id),
+            'user_identifier': user_identifier,
+            'count': count,
+        } for service_id, user_identifier, count in rollups.get_top_identifiers(service, hours)]
+        return self.render_to_response({
+            'hours': hours,
+            'service_rows': service_rows,
+            'top_identifiers': top_identifiers,
+            'is_meta': service is None,
+        })